@@ -22,7 +22,10 @@
 from __future__ import division
 import random
 import numpy as np
-from hmmlearn import hmm
+import profiling
+
+# Probability that an ancestry call is wrong, for the hmm smoother
+smoothing_error_rate = 0.01
 
 ########################################################################################################## 
 
@@ -36,12 +39,18 @@ def ancestry_n_tracebacks(viterbi_object, sample_indices, snp_pos, options, geno
     phase=None
     parents=None
     ancestry=None
-    tbs=viterbi_object.traceback(n_paths= options["n_traceback_paths"], use_everything=False )
+    prof=options.get("profiler", profiling.profiler())
+
+    with prof.stage("traceback"):
+        tbs=viterbi_object.traceback(n_paths= options["n_traceback_paths"], use_everything=options.get("everything", False) )
                 
-    parents=[[(sample_indices[p1],sample_indices[p2]) for p1,p2 in order_parents(this_tb)] for this_tb in tbs]
-    ancestries=[[(options["populations"][p1],options["populations"][p2]) for p1,p2 in pars] for pars in parents]
-    ancestry=combine_ancestry(ancestries)
-    ancestry=smooth_ancestry(ancestry, options, snp_pos)
+    with prof.stage("ancestry"):
+        parents=[[(sample_indices[p1],sample_indices[p2]) for p1,p2 in order_parents(this_tb)] for this_tb in tbs]
+        ancestries=[[(options["populations"][p1],options["populations"][p2]) for p1,p2 in pars] for pars in parents]
+        ancestry=combine_ancestry(ancestries)
+        ancestry=smooth_ancestry(ancestry, options, snp_pos)
+        if options["smooth_output"]:
+            ancestry=smooth_ancestry_hmm(ancestry, options, snp_pos)
 
     return {"best_parents":parents[0], "local_ancestry":ancestry}
 
@@ -76,31 +85,62 @@ def smooth_ancestry(ancestry, options, snp_pos):
 
 def smooth_ancestry_hmm(ancestry, options, snp_pos):
     """
-    Smooth phasing with an hmm.
+    Smooth phased ancestry with an hmm. The hidden states are ordered pairs of 
+    population labels, and each call is wrong with probability smoothing_error_rate. 
+    Each haplotype switches ancestry at rate options["generations"] per Morgan, to 
+    a random label (possibly the same one). Returns the most likely (viterbi) path. 
     """
-    transition_prob=options["generations"]/2/len(snp_pos)
-    entries=list(set(ancestry))
-    entries.sort()
-    observations=np.array([entries.index(a) for a in ancestry])
-    observations=observations.reshape(-1,1)
-    
-    n_components=len(entries)
-    startprob_prior=np.zeros(n_components)+1/n_components
-    transmat_prior=np.zeros((n_components,n_components))+transition_prob
-    np.fill_diagonal(transmat_prior, 1-(n_components-1)*transition_prob)
-
-    model=hmm.MultinomialHMM(n_components=n_components, startprob_prior=startprob_prior,
-                                 transmat_prior=transmat_prior, params='e', init_params='es')
-
-    model.transmat_=transmat_prior
-    
-    model.fit(observations)
-
-    smoothed_ancestry=[entries[a] for a in model.decode(observations, algorithm="viterbi")[1]]
-
-    pdb.set_trace()
-
-    return smoothed_ancestry
+    labels=sorted(set(options["populations"]))
+    n_labels=len(labels)
+    pairs=[(a,b) for a in labels for b in labels]
+    n_states=len(pairs)
+    state_index=dict((p,k) for k,p in enumerate(pairs))
+    observations=np.array([state_index[a] for a in ancestry])
+    n_sites=len(observations)
+
+    recombinator=options["recombinator"]
+    morgans=np.array([recombinator.distance(snp_pos[i-1], snp_pos[i]) for i in range(1,n_sites)])/100
+    switch=1-np.exp(-options["generations"]*morgans)
+
+    with np.errstate(divide="ignore"):
+        log_stay=np.log(1-switch+switch/n_labels)
+        log_move=np.log(switch/n_labels)
+    log_right=np.log(1-smoothing_error_rate)
+    log_wrong=np.log(smoothing_error_rate/max(n_states-1, 1))
+
+    # The transition is a product of one term for each haplotype, so find the best previous 
+    # state one haplotype at a time - O(n_labels^2) per snp rather than O(n_states^2). The 
+    # viterbi values are a matrix with rows for the first label and columns for the second. 
+    labels_k=np.arange(n_labels)
+    viterbi=np.full(n_states, log_wrong)
+    viterbi[observations[0]]=log_right
+    viterbi=(viterbi-np.log(n_states)).reshape(n_labels, n_labels)
+    traceback=np.zeros((n_sites, n_states), dtype=int)
+    for i in range(1, n_sites):
+        # Previous first label, for each first label and previous second label
+        best_first=viterbi.argmax(axis=0)
+        stay=viterbi+log_stay[i-1]
+        move=viterbi[best_first, labels_k]+log_move[i-1]
+        from_first=np.where(stay>=move[None,:], labels_k[:,None], best_first[None,:])
+        first_done=np.maximum(stay, move[None,:])
+
+        # Then the previous second label, for each state
+        best_second=first_done.argmax(axis=1)
+        stay=first_done+log_stay[i-1]
+        move=first_done[labels_k, best_second]+log_move[i-1]
+        from_second=np.where(stay>=move[:,None], labels_k[None,:], best_second[:,None])
+
+        traceback[i]=(from_first[labels_k[:,None], from_second]*n_labels+from_second).ravel()
+        emission=np.full(n_states, log_wrong)
+        emission[observations[i]]=log_right
+        viterbi=np.maximum(stay, move[:,None])+emission.reshape(n_labels, n_labels)
+
+    path=np.zeros(n_sites, dtype=int)
+    path[-1]=viterbi.argmax()    # Flattened, this is the state index
+    for i in range(n_sites-1, 0, -1):
+        path[i-1]=traceback[i,path[i]]
+
+    return [pairs[k] for k in path]
         
 ########################################################################################################## 
 
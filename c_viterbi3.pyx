@@ -20,10 +20,10 @@
 # This is the cython version of veiterbi2.py. It should be much faster
 
 from __future__ import division
-from scipy import interpolate, sparse
+from scipy import sparse
 from math import exp, log, fsum
 from collections import defaultdict
-from viterbi_2d_helpers import transition, emission, pseudohaploid_emission
+from viterbi_2d_helpers import transition, emission, pseudohaploid_emission, informative_sites, expanded_calculator, start_states
 import numpy as np
 cimport numpy as np
 
@@ -32,6 +32,66 @@ cimport cython
 
 max_num_sparse_elems = 1e6
 
+# Number of snps to work out transition and emission probabilities for (and read the
+# panel genotypes for) at a time, before running them without the gil
+precompute_chunk_size = 1000
+
+##########################################################################################################
+
+cdef inline bint ranks_before(np.float64_t value_a, int a, np.float64_t value_b, int b) nogil:
+    """
+    Order for informative states: higher value first, ties going to the lower state.
+    """
+    return value_a>value_b or (value_a==value_b and a<b)
+
+cdef void sift_down(np.int_t[::1] heap, int n, int pos, np.float64_t[::1] lastV, np.float64_t tp2) nogil:
+    """
+    Restore a heap of states with the one which ranks last at the top, from pos down.
+    """
+    cdef int child, k
+    while 2*pos+1<n:
+        child=2*pos+1
+        if child+1<n and ranks_before(lastV[heap[child]]*tp2, heap[child], lastV[heap[child+1]]*tp2, heap[child+1]):
+            child+=1
+        if not ranks_before(lastV[heap[pos]]*tp2, heap[pos], lastV[heap[child]]*tp2, heap[child]):
+            break
+        k=heap[pos]
+        heap[pos]=heap[child]
+        heap[child]=k
+        pos=child
+
+cdef int top_informative(np.uint8_t[::1] informative, np.float64_t[::1] lastV, np.float64_t tp2, int Ns, int m, np.int_t[::1] order) nogil:
+    """
+    Put the (at most) m informative states that rank first by lastV*tp2 into order, best first, 
+    and return how many there are. Keeps a heap of the best m so far - O(Ns log m).
+    """
+    cdef int k, n=0, pos, parent
+    for k from 0 <= k < Ns:
+        if not informative[k]:
+            continue
+        if n<m:
+            pos=n
+            order[pos]=k
+            n+=1
+            while pos>0:
+                parent=(pos-1)//2
+                if not ranks_before(lastV[order[parent]]*tp2, order[parent], lastV[order[pos]]*tp2, order[pos]):
+                    break
+                order[pos]=order[parent]
+                order[parent]=k
+                pos=parent
+        elif ranks_before(lastV[k]*tp2, k, lastV[order[0]]*tp2, order[0]):
+            order[0]=k
+            sift_down(order, n, 0, lastV, tp2)
+
+    # Take the last ranked off the top, and put it at the end
+    for pos from n-1 >= pos > 0:
+        k=order[0]
+        order[0]=order[pos]
+        order[pos]=k
+        sift_down(order, pos, 0, lastV, tp2)
+    return n
+
 ##########################################################################################################
 
 class calculator(object):
@@ -41,14 +101,24 @@ class calculator(object):
     being your parents. 
     """
 
-    def __init__(self, data, transition, emission, observed, options={}):
+    def __init__(self, data, transition, emission, observed, options={}, columns=None):
+        """
+        data is the genotype matrix, and columns are the columns of it that make up the 
+        panel - all of them if columns is None. We only look the panel up through columns, 
+        so data can be shared between samples without copying. It is read a chunk of snps
+        at a time, so it only has to be sliceable by rows - an array, a memory mapped one,
+        or a lace_io.row_reader. 
+        """
         self.data=data
+        if columns is None:
+            columns=np.arange(len(data[0]))
+        self.columns=np.asarray(columns, dtype=np.int32)
         self.transition=transition
 
         self.observed=np.array(observed)
         self.emission=emission
         self.Nx = len(data)
-        self.Ny = len(data[0])
+        self.Ny = len(self.columns)
         self.options=options
         self.stored_ordered_states=None
         self.frequency=options["used_genotype_frequency"]
@@ -65,6 +135,12 @@ class calculator(object):
             for j in range(i):
                 self.states.append((i,j))
 
+    def panel_rows(self, start, end):
+        """
+        The panel genotypes for snps start to end, as a contiguous uint8 array
+        """
+        return np.ascontiguousarray(np.asarray(self.data[start:end])[:,self.columns], dtype=np.uint8)
+
     def convert_emission_to_matrix(self, f):
         """
         Convert the dictionary based lookup from the emission object to an array based lookup
@@ -104,33 +180,67 @@ class calculator(object):
         cdef int Ny = self.Ny  # Number of samples
         cdef int Ns = self.Ns     # Number of states ( samples^2 but state[0] > state[1] )
         cdef int nse = 0        # Counter for number of elements in traceback
-        cdef int i,j,k,s0,s1, best_idx, idx, next_idx, tb_k, best_move_idx, gt_sum
+        cdef long total_nse = 0 # Total number of elements stored, over all flushes
+        cdef int n_flushes = 0  # Number of times the element buffers were flushed to the sparse matrix
+        cdef int i,j,k,s0,s1, best_idx, idx, next_idx, tb_k, best_move_idx, gt_sum, p, q, n_informative, n_ordered
+        cdef bint phase_this_snp, sorted_informative, traceback_this_iteration
 
-        cdef int max_nse =  max_num_sparse_elems
+        cdef int max_nse =  self.options.get("sparse_buffer_size", max_num_sparse_elems)
         cdef int max_tb_k = self.options["traceback_lookback_k"]
-        cdef np.float64_t best, best_value, tp0, tp1, best_last_V, best_last_V_tp1, best_i, best_j, best_move, thisVal
+        cdef np.float64_t best, best_value, tp0, tp1, tp2, best_last_V, best_last_V_tp1, best_i, best_j, best_move, thisVal
+        cdef np.float64_t best_informative
 
-        # Type all the members we need locally as numpy arrays. 
-        cdef np.ndarray[np.int_t, ndim=2] data=self.data
-        cdef np.ndarray[np.int_t, ndim=2] states=np.array(self.states)
-        cdef np.ndarray[np.int_t, ndim=1] observed=self.observed
+        # Type all the members we need locally as memoryviews, so that the main loop can run
+        # without the gil. Keep the arrays too, for the bits that need python. 
+        cdef np.uint8_t[:, ::1] panel     # The panel genotypes for the current chunk of snps
+        states_arr=np.array(self.states, dtype=int).reshape(-1,2)
+        cdef np.int_t[:, ::1] states=states_arr
+        cdef np.int_t[::1] observed=np.ascontiguousarray(self.observed, dtype=int)
 
         #These are used for building the sparse traceback matrix
-        cdef np.ndarray[np.int_t, ndim=1] I=np.zeros(max_nse, dtype=int)
-        cdef np.ndarray[np.int_t, ndim=1] J=np.zeros(max_nse, dtype=int)
-        cdef np.ndarray[np.int_t, ndim=1] V=np.zeros(max_nse, dtype=int)
-        cdef np.ndarray[np.int_t, ndim=2] tb_arr=np.zeros((max_tb_k,Ns), dtype=int)
+        I_arr=np.zeros(max_nse, dtype=int)
+        J_arr=np.zeros(max_nse, dtype=int)
+        V_arr=np.zeros(max_nse, dtype=int)
+        cdef np.int_t[::1] I=I_arr
+        cdef np.int_t[::1] J=J_arr
+        cdef np.int_t[::1] V=V_arr
+        cdef np.int_t[:, ::1] tb_arr=np.zeros((max_tb_k,Ns), dtype=int)
 
         # used for bits of the Viterbi algorithm
-        cdef np.ndarray[double, ndim=1] initial_p=np.array(self.initial_p)
-        cdef np.ndarray[np.float64_t, ndim=1] thisV=np.zeros(Ns, dtype=np.float64)
-        cdef np.ndarray[np.float64_t, ndim=1] lastV=np.zeros(Ns, dtype=np.float64)
-        cdef np.ndarray[np.float64_t, ndim=1] best_values=np.zeros(Ny, dtype=np.float64)
-        cdef np.ndarray[np.int_t, ndim=1] best_idxes=np.zeros(Ny, dtype=int)
+        cdef np.float64_t[::1] initial_p=np.array(self.initial_p, dtype=np.float64)
+        thisV_arr=np.zeros(Ns, dtype=np.float64)
+        lastV_arr=np.zeros(Ns, dtype=np.float64)
+        cdef np.float64_t[::1] thisV=thisV_arr
+        cdef np.float64_t[::1] lastV=lastV_arr
+        cdef np.float64_t[::1] best_values=np.zeros(Ny, dtype=np.float64)
+        cdef np.int_t[::1] best_idxes=np.zeros(Ny, dtype=int)
         cdef np.ndarray[np.float64_t, ndim=3] em=np.zeros((4,4,4), dtype=np.float64)    
 
+        # Transition probabilities and emission tables for a chunk of snps, worked out (in python) 
+        # before we run the chunk. The emission table has the emission probability for each pair 
+        # of parent genotypes (indexed by 4*first+second) given the observed genotype, so that the 
+        # loop over states only has to look things up in it and in the genotypes at this snp. 
+        cdef int chunk_start, chunk_end, c
+        cdef int chunk_size = precompute_chunk_size
+        cdef np.float64_t[:, ::1] tps=np.zeros((chunk_size,3), dtype=np.float64)
+        cdef np.float64_t[:, ::1] em_pairs=np.zeros((chunk_size,16), dtype=np.float64)
+        cdef np.uint8_t[::1] row=np.zeros(Ny, dtype=np.uint8)
+        cdef int row_code
+
+        # Used for phasing everything: which states are informative (heterozygous) at the last snp, 
+        # the best two informative states including each parent (by value times tp1), and the 
+        # informative states in order of value, which we only sort if we need to. 
+        informative_arr=np.zeros(Ns, dtype=np.uint8)
+        informative_order_arr=np.zeros(min(Ns, 2*Ny), dtype=int)
+        cdef np.uint8_t[::1] informative=informative_arr
+        cdef np.float64_t[::1] top_values=np.zeros(Ny, dtype=np.float64)
+        cdef np.int_t[::1] top_idxes=np.zeros(Ny, dtype=int)
+        cdef np.float64_t[::1] second_values=np.zeros(Ny, dtype=np.float64)
+        cdef np.int_t[::1] second_idxes=np.zeros(Ny, dtype=int)
+        cdef np.int_t[::1] informative_order=informative_order_arr
+
         # Cache the indices to look up. 
-        cdef np.ndarray[np.int_t, ndim=2] state_indices=np.zeros((Ny,Ny), dtype=int)
+        cdef np.int_t[:, ::1] state_indices=np.zeros((Ny,Ny), dtype=int)
 
         # Sparse matrix - not a cdef. Would be nice if we had one.
         t = sparse.lil_matrix((Nx,Ns), dtype=int).tocoo()
@@ -146,8 +256,9 @@ class calculator(object):
         best_last_V=-1.0
         tb_k=0
 
+        panel=self.panel_rows(0, 1)
         for j from 0 <= j < Ns:
-            lastV[j]=initial_p[j]*self.emission.emission_probability((data[0,states[j,0]], data[0,states[j,1]]), observed[0], self.frequency[0])
+            lastV[j]=initial_p[j]*self.emission.emission_probability((panel[0,states[j,0]], panel[0,states[j,1]]), observed[0], self.frequency[0])
             tb_arr[0,j]=j
             if best_last_V < lastV[j]:
                 best_last_V = lastV[j]
@@ -159,121 +270,209 @@ class calculator(object):
             for j from 0 <= j < Ns:
                 lastV[j] = 1/Ns 
             
-        # For each snp
-        for i from 1 <= i < Nx:
-
-            # Get the transition probabilities
-            tp = self.transition.single_transition_probability(i)
-            tp0 = tp[0]
-            tp1 = tp[1]
-            tp2 = tp[2]         # Only used if we are phasing everything. 
-            best_last_V_tp1=best_last_V*tp1
-
-	    # Get the emission matrix
-            em=self.convert_emission_to_matrix(self.frequency[i])
-            #Calculate the best transitions for each i, j                
-            for j from 0<=j<Ny:
-                best = -1.0
-                for k from 0<=k<Ny:
-                    idx = state_indices[j,k]
+        # For each chunk of snps
+        chunk_start=1
+        while chunk_start < Nx:
+            chunk_end=min(Nx, chunk_start+chunk_size)
+            panel=self.panel_rows(chunk_start-1, chunk_end)    # Snp i is row c+1 (c=i-chunk_start)
+            for i from chunk_start <= i < chunk_end:
+                c=i-chunk_start
+                tp = self.transition.single_transition_probability(i)
+                tps[c,0]=tp[0]
+                tps[c,1]=tp[1]
+                tps[c,2]=tp[2]
+                em=self.convert_emission_to_matrix(self.frequency[i])
+                for k from 0 <= k < 16:
+                    em_pairs[c,k]=em[k//4, k%4, observed[i]]
+
+            with nogil:
+              # For each snp
+              for i from chunk_start <= i < chunk_end:
+                c=i-chunk_start
+
+                # Get the transition probabilities
+                tp0 = tps[c,0]
+                tp1 = tps[c,1]
+                tp2 = tps[c,2]         # Only used if we are phasing everything. 
+                best_last_V_tp1=best_last_V*tp1
+
+                # If we are phasing everything, and the last site was heterozygous, then summarise the 
+                # informative states at the last snp so that we can find the best one for each state
+                # without looking at all the others. 
+                phase_this_snp = everything and observed[i-1]==1
+                if phase_this_snp:
+                    for p from 0 <= p < Ny:
+                        top_values[p]=-1.0
+                        top_idxes[p]=-1
+                        second_values[p]=-1.0
+                        second_idxes[p]=-1
+                    best_informative=-1.0
+                    n_informative=0
+                    for k from 0 <= k < Ns:
+                        informative[k] = panel[c,states[k,0]]!=panel[c,states[k,1]]
+                        if informative[k]:
+                            n_informative+=1
+                            if lastV[k]>best_informative:
+                                best_informative=lastV[k]
+                            thisVal=lastV[k]*tp1
+                            for q from 0 <= q < 2:
+                                p=states[k,q]
+                                if thisVal>top_values[p]:
+                                    second_values[p]=top_values[p]
+                                    second_idxes[p]=top_idxes[p]
+                                    top_values[p]=thisVal
+                                    top_idxes[p]=k
+                                elif thisVal>second_values[p]:
+                                    second_values[p]=thisVal
+                                    second_idxes[p]=k
+                    sorted_informative=False
+
+                # The genotypes at this snp
+                for k from 0 <= k < Ny:
+                    row[k]=panel[c+1,k]
+
+                #Calculate the best transitions for each i, j                
+                for j from 0<=j<Ny:
+                    best = -1.0
+                    for k from 0<=k<Ny:
+                        idx = state_indices[j,k]
                     
-                    if lastV[idx] > best:
-                        best_values[j]=lastV[idx]*tp1
-                        best_idxes[j]=idx
-                        best=lastV[idx]
-
-            #traceback if we're on a multiple of chunk size, or at the end
-            traceback_this_iteration=(tb_k+1==max_tb_k) or (i+1==Nx)
-
-            # For each state see what the most likely previous state was. 
-            for j from 0 <= j < Ns:
-                best = lastV[j]*tp0
-                best_idx = j
-                s0 = states[j,0]
-                s1 = states[j,1]
-
-                if best < best_last_V_tp1: # If it might be better to move
-
-                    best_i = best_values[s0] # best value if we let first index vary
-                    best_j = best_values[s1] # best value if we let second index vary
+                        if lastV[idx] > best:
+                            best_values[j]=lastV[idx]*tp1
+                            best_idxes[j]=idx
+                            best=lastV[idx]
+
+                #traceback if we're on a multiple of chunk size, or at the end
+                traceback_this_iteration=(tb_k+1==max_tb_k) or (i+1==Nx)
+
+                # For each state see what the most likely previous state was. States are in order
+                # of first then second parent: (1,0), (2,0), (2,1), (3,0)...
+                s0 = 1
+                s1 = 0
+                row_code = 4*row[1]
+                for j from 0 <= j < Ns:
+                    best = lastV[j]*tp0
+                    best_idx = j
+
+                    if best < best_last_V_tp1: # If it might be better to move
+
+                        best_i = best_values[s0] # best value if we let first index vary
+                        best_j = best_values[s1] # best value if we let second index vary
                 
-                    if best_i < best_j:
-                        best_move = best_j
-                        best_move_idx = best_idxes[s1]
-                    else:
-                        best_move = best_i
-                        best_move_idx = best_idxes[s0]
+                        if best_i < best_j:
+                            best_move = best_j
+                            best_move_idx = best_idxes[s1]
+                        else:
+                            best_move = best_i
+                            best_move_idx = best_idxes[s0]
                     
-                    if best < best_move:
-                        best=best_move
-                        best_idx=best_move_idx
-
-                thisV[j]=best*em[data[i,s0], data[i,s1], observed[i]]
-                tb_arr[tb_k,j]=best_idx
-                # If we have demanded that we phase *everything* and site we're going to is not phasable 
-                # then try and find the best informative state. If none of them are informative give up
-                # (but we might phase randomly later)
-                if everything:
-                    if observed[i-1]==1 and data[i-1,states[best_idx,0]]==data[i-1,states[best_idx,1]]: 
+                        if best < best_move:
+                            best=best_move
+                            best_idx=best_move_idx
+
+                    thisV[j]=best*em_pairs[c,row_code+row[s1]]
+                    tb_arr[tb_k,j]=best_idx
+                    # If we have demanded that we phase *everything* and site we're going to is not phasable 
+                    # then try and find the best informative state. If none of them are informative give up
+                    # (but we might phase randomly later)
+                    if phase_this_snp and not informative[best_idx]:
+                        # Find the best informative state, k, to come from. The value of coming from k is 
+                        # lastV[k] times tp0 if k==j, tp1 if k shares one parent with j, and tp2 if
+                        # it shares none. Ties go to the lowest k. 
                         best=0
                         best_idx=-1
-                        for k from 0<=k<Ns:
-                            if data[i-1,states[k,0]]!=data[i-1,states[k,1]]:
-                                thisVal=lastV[k]
+                        if informative[j]:
+                            thisVal=lastV[j]*tp0
+                            if thisVal>best:
+                                best=thisVal
+                                best_idx=j
+
+                        for q from 0 <= q < 2:
+                            p=states[j,q]
+                            if top_idxes[p]!=j:
+                                k=top_idxes[p]
+                                thisVal=top_values[p]
+                            else:
+                                k=second_idxes[p]
+                                thisVal=second_values[p]
+                            if k>=0 and (thisVal>best or (thisVal==best and best_idx>=0 and k<best_idx)):
+                                best=thisVal
+                                best_idx=k
+
+                        # States which share no parent with j. Go down the informative states in order, 
+                        # stopping at the first one which doesn't share a parent, or which can't win.
+                        # At most 2*Ny-3 states share a parent with j, so we only need the first 2*Ny.
+                        if best_informative*tp2>=best and n_informative>0:
+                            if not sorted_informative:
+                                n_ordered=top_informative(informative, lastV, tp2, Ns, 2*Ny, informative_order)
+                                sorted_informative=True
+                            for idx from 0 <= idx < n_ordered:
+                                k=informative_order[idx]
+                                thisVal=lastV[k]*tp2
+                                if thisVal<best or (thisVal==best and (best_idx<0 or k>best_idx)):
+                                    break
                                 if states[k,0]!=s0 and states[k,0]!=s1 and states[k,1]!=s0 and states[k,1]!=s1:
-                                    thisVal *= tp2
-                                elif states[k,0]==s0 and states[k,1]==s1:
-                                    thisVal *= tp0
-                                else:
-                                    thisVal *= tp1
-                                
-                                if thisVal>best:
                                     best=thisVal
                                     best_idx=k
+                                    break
 
                         if best_idx>-1: # If we found something - flip traceback
                             tb_arr[tb_k,j]=-best_idx-2 # this is negative so that we can tell that we only came here for one site. 
 
-                if traceback_this_iteration:
-                    idx = j
-                    for k from 0 <= k < tb_k:
-                        if idx == -1:
-                            break
-                        next_idx = tb_arr[tb_k-k,idx]                            
-
-                        tb_arr[tb_k-k,idx]=-1
-
-                        if next_idx!=idx:
-                            I[nse]=i-k
-                            J[nse]=idx
-                            V[nse]=next_idx+1 # Sparse matrix returns 0 for empty, so shift everything by 1
-                            nse+=1
-                            if nse > max_nse:
-                                t=t+sparse.coo_matrix((V,(I,J)),shape=(Nx,Ns),dtype=int)
-                                nse=0            
-                            if next_idx>=0:
-                                idx=next_idx
-
-            # Back to outer loop ( i over Nx ) 
-            # Move traceback on, wrapping round if required
-            tb_k = (tb_k + 1) % max_tb_k
-
-            best_last_V=-1.0
-            for j from 0 <= j < Ns:
-                if best_last_V < thisV[j]:
-                    best_last_V = thisV[j]
-
-            for j from 0 <= j < Ns: 
-                thisV[j] = thisV[j]/best_last_V
-                lastV[j] = thisV[j]
-
-            best_last_V=1.0 # We are normalising everything so that the best element==1
+                    if traceback_this_iteration:
+                        idx = j
+                        for k from 0 <= k < tb_k:
+                            if idx == -1:
+                                break
+                            next_idx = tb_arr[tb_k-k,idx]                            
+
+                            tb_arr[tb_k-k,idx]=-1
+
+                            if next_idx!=idx:
+                                I[nse]=i-k
+                                J[nse]=idx
+                                V[nse]=next_idx+1 # Sparse matrix returns 0 for empty, so shift everything by 1
+                                nse+=1
+                                if nse == max_nse:
+                                    with gil:
+                                        t=t+sparse.coo_matrix((V_arr,(I_arr,J_arr)),shape=(Nx,Ns),dtype=int)
+                                    total_nse+=nse
+                                    n_flushes+=1
+                                    nse=0            
+                                if next_idx>=0:
+                                    idx=next_idx
+
+                    # Next state
+                    s1+=1
+                    if s1==s0:
+                        s0+=1
+                        s1=0
+                        if s0<Ny:
+                            row_code=4*row[s0]
+
+                # Back to outer loop ( i over Nx ) 
+                # Move traceback on, wrapping round if required
+                tb_k = (tb_k + 1) % max_tb_k
+
+                best_last_V=-1.0
+                for j from 0 <= j < Ns:
+                    if best_last_V < thisV[j]:
+                        best_last_V = thisV[j]
+
+                for j from 0 <= j < Ns: 
+                    thisV[j] = thisV[j]/best_last_V
+                    lastV[j] = thisV[j]
+
+                best_last_V=1.0 # We are normalising everything so that the best element==1
+
+            chunk_start=chunk_end
                 
         # Finally save everything
-        self.viterbi = thisV
-        t=t+sparse.coo_matrix((V[:nse],(I[:nse],J[:nse])),shape=(Nx,Ns),dtype=int)
+        self.viterbi = thisV_arr
+        t=t+sparse.coo_matrix((V_arr[:nse],(I_arr[:nse],J_arr[:nse])),shape=(Nx,Ns),dtype=int)
         self.traceback_matrix = t.tocsr()
         self.stored_ordered_states=None
+        self.counters = {"snps":Nx, "states":Ns, "traceback_entries":total_nse+nse, "sparse_flushes":n_flushes+1}
 
     def ordered_viterbi_states(self):
         """
@@ -296,43 +495,50 @@ class calculator(object):
         which path=i gets the i+1th best path.  
         """
         cdef int max_tb_k = self.options["traceback_lookback_k"]
-        cdef np.ndarray[np.int_t, ndim=2] t=self.traceback_matrix[(self.Nx-max_tb_k):self.Nx,:].todense()
         cdef int Nx = self.Nx     # Number of markers
-        cdef int i,j, t_i, s_i
-        cdef np.ndarray[np.int_t, ndim=1] index=np.zeros(n_paths, dtype=int)
-
-        i=0
-        j=0
+        cdef int n = n_paths
+        cdef bint everything = use_everything
+        cdef int i,j, t_i, s_i, back_trace, chunk_start, chunk_end
 
-        tb = [[None]*len(self.observed) for k in range(n_paths)]
-        one_step_index=[None]*n_paths
+        # Copy the traceback matrix into a c array in chunks for fast indexing, starting at the end
+        t_arr=np.ascontiguousarray(self.traceback_matrix[(self.Nx-max_tb_k):self.Nx,:].toarray(), dtype=int)
+        cdef np.int_t[:, ::1] t=t_arr
 
         ordered_elems=self.ordered_viterbi_states()
-        index=np.array([ordered_elems[s] for s in range(n_paths)])
-       
-        for i from 0<=i<Nx:
-            t_i=i % max_tb_k
-            s_i=max_tb_k-t_i-1
-
-            if t_i==0 and i>0:
+        cdef np.int_t[::1] index=np.array(start_states(ordered_elems, self.states, n_paths, self.options), dtype=int)
+        cdef np.int_t[::1] one_step_index=-np.ones(n_paths, dtype=int) # -1 for none
+        path_arr=np.zeros((n_paths, Nx), dtype=int)
+        cdef np.int_t[:, ::1] path=path_arr
+
+        chunk_start=0
+        while chunk_start < Nx:
+            if chunk_start>0:
+                i=chunk_start
                 start=max(0,self.Nx-i-max_tb_k)-(self.Nx-i-max_tb_k)
-                t[start:max_tb_k,]=self.traceback_matrix[max(0,self.Nx-i-max_tb_k):(self.Nx-i),:].todense() # copy the traceback matrix into a c array in chunks for fast indexing
-            for j from 0<=j<n_paths:
-                if one_step_index[j]:
-                    tb[j][i]=self.states[one_step_index[j]]
-                    one_step_index[j]=None
-                else: 
-                    tb[j][i]=self.states[index[j]]
-
-                    back_trace=t[s_i,index[j]]-1
-                    if back_trace>=0:
-                        index[j]=back_trace
-                    if back_trace<=-2 and use_everything:   # jump off the optimal path for one step to avoid unphasable site. 
-                        one_step_index[j]=-back_trace-2
-       
-        [tr.reverse() for tr in tb]
-        return tb
+                t_arr[start:max_tb_k,]=self.traceback_matrix[max(0,self.Nx-i-max_tb_k):(self.Nx-i),:].toarray()
+            chunk_end=min(Nx, chunk_start+max_tb_k)
+
+            with nogil:
+                for i from chunk_start <= i < chunk_end:
+                    t_i=i % max_tb_k
+                    s_i=max_tb_k-t_i-1
+                    for j from 0 <= j < n:
+                        if one_step_index[j]>=0:
+                            path[j,i]=one_step_index[j]
+                            one_step_index[j]=-1
+                        else: 
+                            path[j,i]=index[j]
+
+                            back_trace=t[s_i,index[j]]-1
+                            if back_trace>=0:
+                                index[j]=back_trace
+                            if back_trace<=-2 and everything:   # jump off the optimal path for one step to avoid unphasable site. 
+                                one_step_index[j]=-back_trace-2
+
+            chunk_start=chunk_end
+
+        # We went from the end, so reverse
+        states=self.states
+        return [[states[k] for k in path_arr[j,::-1].tolist()] for j in range(n_paths)]
         
-
-
 ##########################################################################################################
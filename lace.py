@@ -22,15 +22,28 @@ import lace_io as io
 import recombination as rec   
 import numpy as np  
 import preclustering as pre
-from numpy import array
+import profiling
+import two_pass
+from viterbi_2d_helpers import panel_blocks
 from collections import defaultdict
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 ##########################################################################################################
 
 # algorithm name to module map:
 # viterbi - full 2 parent viterbi algorithm, implemented in cython
-algo_defs = { "viterbi":"c_viterbi3" }
+# numpy   - the same algorithm in numpy: no compiling needed, and the same results
+algo_defs = { "viterbi":"c_viterbi3", "numpy":"np_viterbi" }
+
+# Set in each pool worker by init_worker
+worker_state = {}
+
+# For --max_memory: the peak bytes used per stored traceback entry (the sparse matrix 
+# and its copies while it is added to and converted), and the memory a process uses 
+# before it loads any data. 
+traceback_entry_bytes = 40
+process_overhead_bytes = 80*1024*1024
 
 ##########################################################################################################
 
@@ -46,6 +59,9 @@ def help():
     print "-r*   [recombination] map file or constant cm/mb"
     print "-o*   [out]put file root"
     print "-t*   [population] labels - one per line"
+    print "--build_index* Build a panel index in this directory from the input, and stop"
+    print "--index*       Use this panel index as the panel, with the input as query samples"
+    print "--stream       With --index, read the panel from disk a block of snps at a time, instead of into memory"
     print "-b    output [best_parents]"
     print "-z    output [gzip]ped files"
     print
@@ -55,28 +71,53 @@ def help():
     print "-i*   calculate for these [individual]s - comma sep list or file with one per line"
     print "-n*   use a [panel] of only these individuals - as -i option"
     print "-u*   [multi_process]ing: use this many processes"
+    print "--threads* Use this many threads, which share one copy of the data (instead of -u)"
     print "-x*   Only consider the first [max_snps] snps"
     print "-c*   Select only this many [closest] samples to query for each individual"
+    print "-d    [dedup]licate - collapse identical panel samples from the same population"
+    print "--skip Skip snps which carry no information (missing, or the same in the whole panel) - faster but approximate"
+    print "--two_pass* Run every n-th snp first, then all snps only around switches - faster but approximate"
+    print "--two_pass_check Also do a full run for each sample and report how often the two agree"
+    print "--shard* Run only shard i of N (i/N, from 1/N to N/N) of the samples, balanced by cost"
+    print "--merge* Merge the output of N shards written to the same -o root"
+    print "-k    [checkpoint] each sample under {out}.checkpoints and skip samples already done"
+    print "--max_memory* Choose -u, --tbk and buffer sizes to fit in this many Mb"
     print
     print "Other settings"
+    print "--algorithm* viterbi (default, compiled) or numpy (no compiling, slower)"
     print "--Ne*  Change Ne. Presumably you know what you're doing"
     print "--tbk* Number of steps to check traceback chunks - for viterbi: a memory/speed tradeoff"    
     print "--mtp* Mutation probability - probability of imperfect copying. Default 0.01"
     print "--thw* Triple heterozgote weight - use to downweight the trple het probability. Default 0.01"
     print "--npt* Number of traceback paths to use for ancestry - the more you use, the more you phase"
-    print "--smo Smooth output"
+    print "--everything Try to phase everything - step off the best path to avoid unphasable sites"
+    print "--smo Smooth output with an hmm over the ancestry calls"
+    print "--generations* Generations since admixture, for --smo. Default 10"
+    print "--safe     Don't stop if a sample fails - retry it, then report it at the end"
+    print "--retries* Number of times to retry failed samples in --safe mode. Default 1"
+    print "--serve*   Keep the panel loaded and answer queries (json lines) on this unix socket, or - for stdin/stdout"
+    print "--profile*  Write a json report of time and memory used by each stage and sample"
+    print "--cprofile  Also dump cProfile stats for each sample next to the --profile report"
 
 
 ##########################################################################################################
 
+def default_options():
+    """
+    Default values of the options
+    """
+    return { "Ne": 14000, "out":"pace.out", "algorithm":"viterbi", "traceback_lookback_k":100, "recombination_map":"1", "mutation_probability":0.01, "pseudo_haploid":False, "populations":None,  "triple_het_weight":0.01, "n_traceback_paths":9, "window":1, "smooth_output":False, "generations":10, "retries":1}
+
+##########################################################################################################
+
 def parse_options():
     """
     Options are described by the help() function
     """
-    options ={ "Ne": 14000, "out":"pace.out", "algorithm":"viterbi", "traceback_lookback_k":100, "recombination_map":"1", "mutation_probability":0.01, "pseudo_haploid":False, "populations":None,  "triple_het_weight":0.01, "n_traceback_paths":9, "window":1, "smooth_output":False}
+    options = default_options()
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "m:v:e:r:o:p:bzsi:n:u:x:c:w:", ["help", "eigenstrat=",  "minimal=", "vcf=", "recombination=", "max_snps=", "out=", "best_parents", "pseudo_haploid", "gzip", "phase", "individual=", "multi_process=", "closest=", "Ne=", "tbk=","mtp=",  "panel=", "populations=", "npt=", "window=", "smo"])
+        opts, args = getopt.getopt(sys.argv[1:], "m:v:e:r:o:p:bzsi:n:u:x:c:w:kd", ["help", "eigenstrat=",  "minimal=", "vcf=", "recombination=", "max_snps=", "out=", "best_parents", "pseudo_haploid", "gzip", "phase", "individual=", "multi_process=", "threads=", "closest=", "dedup", "skip", "two_pass=", "two_pass_check", "algorithm=", "Ne=", "tbk=","mtp=",  "panel=", "populations=", "npt=", "everything", "window=", "smo", "generations=", "profile=", "cprofile", "checkpoint", "safe", "retries=", "max_memory=", "shard=", "merge=", "index=", "stream", "build_index=", "serve="])
     except Exception as err:
         print str(err)
         help()
@@ -105,13 +146,37 @@ def parse_options():
         elif o in ["-p","--populations"]:    options["populations"] = io.parse_individual(a)
         elif o in ["-x","--max_snps"]:       options["max_snps"] = int(a)      
         elif o in ["-u","--multi_process"]:  options["multi_process"] = int(a)      
+        elif o in ["--threads"]:             options["threads"] = int(a)
         elif o in ["-c","--closest"]:        options["closest"] = int(a)      
+        elif o in ["-d","--dedup"]:          options["dedup"] = True
+        elif o in ["--skip"]:                options["skip"] = True
+        elif o in ["--two_pass"]:            options["two_pass"] = int(a)
+        elif o in ["--two_pass_check"]:      options["two_pass_check"] = True
+        elif o in ["--algorithm"]:           options["algorithm"] = a
         elif o in ["--Ne"]:                  options["Ne"] = int(a)      
         elif o in ["--tbk"]:                 options["traceback_lookback_k"] = int(a)      
         elif o in ["--mtp"]:                 options["mutation_probability"] = float(a)      
         elif o in ["--thw"]:                 options["triple_het_weight"] = float(a)      
         elif o in ["--npt"]:                 options["n_traceback_paths"] = int(a)      
+        elif o in ["--everything"]:          options["everything"] = True
         elif o in ["--smo"]:                 options["smooth_output"] = True      
+        elif o in ["--generations"]:         options["generations"] = float(a)
+        elif o in ["--serve"]:               options["serve"] = a
+        elif o in ["--index"]:               options["index"] = a
+        elif o in ["--stream"]:              options["stream"] = True
+        elif o in ["--build_index"]:         options["build_index"] = a
+        elif o in ["--shard"]:               options["shard"] = parse_shard(a)
+        elif o in ["--merge"]:               options["merge"] = int(a)
+        elif o in ["-k","--checkpoint"]:     options["checkpoint"] = True
+        elif o in ["--safe"]:                options["safe"] = True
+        elif o in ["--retries"]:             options["retries"] = int(a)
+        elif o in ["--max_memory"]:          options["max_memory"] = int(a)
+        elif o in ["--profile"]:             options["profile"] = a
+        elif o in ["--cprofile"]:            options["cprofile"] = True
+
+    # When serving on stdin/stdout, stdout is only for answers, so everything else goes to stderr
+    if options.get("serve")=="-":
+        sys.stdout=sys.stderr
 
     # Check we entered some sensible data
     validate_options(options)
@@ -125,32 +190,68 @@ def parse_options():
 
 ##########################################################################################################
 
+def parse_shard(arg):
+    """
+    Parse a shard specification i/N into a tuple (i,N), with 1<=i<=N
+    """
+    try:
+        shard, n_shards = [int(x) for x in arg.split("/")]
+    except ValueError:
+        raise Exception("Shard should look like i/N, e.g. 1/10, got " + arg)
+    if not 1<=shard<=n_shards:
+        raise Exception("Shard i/N needs 1<=i<=N, got " + arg)
+    return (shard, n_shards)
+
+##########################################################################################################
+
 def validate_options(options):
     """
     Check that the options we entered are sensible
     """
-    if ("test_file" in options) + ("vcf_file" in options) + ("eigenstrat_root" in options) !=1:
+    if options.get("merge"):    # Merging only needs the output options
+        return
+    n_sources=("test_file" in options) + ("vcf_file" in options) + ("eigenstrat_root" in options)
+    if options.get("serve") and options.get("index"):
+        if n_sources:
+            raise Exception("When serving from a panel index, queries come from the server, not input files")
+    elif n_sources!=1:
         raise Exception("Must specify exactly one data source")
     if not options.get("recombination_map"):
         raise Exception("Must specify recombination map")
-    if not options["populations"]:
+    if not options["populations"] and not options.get("index"):
         raise Exception("Must specify population labels (-p/--populations) to call local ancestry")
+    if options.get("index") and options["populations"]:
+        raise Exception("Population labels come from the panel index, don't specify them with --index")
+    if options.get("index") and options.get("build_index"):
+        raise Exception("Can't use a panel index to build a panel index")
+    if options.get("stream") and not options.get("index"):
+        raise Exception("--stream needs a panel index (--index) to read from")
+    if options["algorithm"] not in algo_defs:
+        raise Exception("Unknown algorithm " + options["algorithm"] + ", should be one of " + ", ".join(sorted(algo_defs)))
+    if options.get("two_pass_check") and not options.get("two_pass"):
+        raise Exception("--two_pass_check needs --two_pass")
+    if options.get("two_pass") is not None and options["two_pass"]<2:
+        raise Exception("--two_pass should be at least 2")
+    if options.get("threads") and options.get("multi_process"):
+        raise Exception("Use either threads (--threads) or processes (-u), not both")
+    if options.get("cprofile") and not options.get("profile"):
+        raise Exception("--cprofile needs a --profile report file to write next to")
     
 ##########################################################################################################
 
 def safe_run_for_one_sample(args):
     """
-    Safe wrapper for nn_for_one_sample. If something goes wrong, just return an empty summary
-    This might give wierd results, but at least it won't just blow up. 
+    Safe wrapper for run_for_one_sample. If something goes wrong, return None so 
+    that calculate_full_matrix can retry the sample, or report it as failed. 
     """
     try:
         out=run_for_one_sample(args)
     except Exception as ex:
-        print "Caught an exception in nn_for_one_sample for sample " + args[0]
-        print "Safe mode: returning result for " + args[0]
+        print "Caught an exception in run_for_one_sample for sample " + args[0]
+        print "Safe mode: will retry or report " + args[0]
         print "Details: " + str(ex)
         print
-        out = {}
+        out = None
 
     return out
 
@@ -166,59 +267,242 @@ def run_for_one_sample(args):
     """
     (sample_name, data, recombinator, options, summary_function) = args
 
+    cprofile_file=None
+    if options.get("cprofile"):
+        chrom=data.get("chrom")
+        cprofile_file=options["profile"]+"."+sample_name+("" if chrom is None else "."+str(chrom))+".prof"
+
+    with profiling.cprofile_to(cprofile_file):
+        out=profiled_run_for_one_sample(args)
+
+    if options.get("checkpoint"):
+        io.save_checkpoint(io.checkpoint_file(options, sample_name, data.get("chrom")), out, io.checkpoint_fingerprint(options))
+
+    return out
+
+##########################################################################################################
+
+def profiled_run_for_one_sample(args):
+    """
+    Does the work for run_for_one_sample, recording the time spent in each stage. 
+    The stage timings and counters are returned with the results, under "profile".
+    """
+    (sample_name, data, recombinator, options, summary_function) = args
+    prof=profiling.profiler()
+
     # Load the right (cython/python) module 
     algorithm=__import__(algo_defs[options["algorithm"]])
 
-    i = data["sample_names"].index(sample_name) # This is the index of the sample to be queried
+    with prof.stage("panel"):
+        include=np.ones(len(data["sample_names"]), dtype=np.bool)
+        if "panel" in options:
+            include=np.in1d(np.array(data["sample_names"]), np.array(options["panel"]))
 
+        # Query samples from a panel index are not in the panel. Otherwise exclude the current sample. 
+        if sample_name in data.get("query_names", []):
+            i = None
+            observations=np.asarray(data["query_genotype_data"][:,data["query_names"].index(sample_name)], dtype=int)
+        else:
+            i = data["sample_names"].index(sample_name) # This is the index of the sample to be queried
+            include[i]=False
+            observations=np.asarray(data["genotype_data"][:,i], dtype=int)
 
-    include=np.ones(len(data["sample_names"]), dtype=np.bool)
-    if "panel" in options:
-        include=np.in1d(np.array(data["sample_names"]), np.array(options["panel"]))
-    # exclude current snp
-    include[i]=False
+        # The panel is the current sample excluded. We don't copy it, just keep its columns
+        panel_data=data["genotype_data"]
+        used_sample_names=[x for x,inc in zip(data["sample_names"],include) if inc]
+        used_sample_indices=np.where(include)[0]
     
-    # Data with the current snp excluded
-    observations=data["genotype_data"][:,i]
-    used_sample_names=[x for x,i in zip(data["sample_names"],include) if i]
-    used_genotype_data=data["genotype_data"][:,include]
-    
-    used_sample_indices=np.where(include)[0]
-    
-    N_samples = sum(include)
-    N_snps = len(data["snp_pos"])
+        N_samples = sum(include)
+        N_snps = len(data["snp_pos"])
+
+        # Precomputed panel summaries, if we have them, are only valid if we are using the whole panel
+        whole_panel = "frequency" in data and include.all()
     
-    # Subsampling
-    if "closest" in options:
-        used_genotype_data, used_sample_names = pre.closest_n( used_genotype_data, used_sample_names, observations, options["closest"] )
+        # Subsampling
+        if "closest" in options:
+            weights=data["closest_weights"] if whole_panel else None
+            used_sample_indices, used_sample_names = pre.closest_n( panel_data, used_sample_indices, used_sample_names, observations, options["closest"], weights=weights )
+            whole_panel=False
+
+    with prof.stage("frequency"):
+        used_options=options.copy()
+        if whole_panel:
+            used_options["used_genotype_frequency"]=data["frequency"]
+        else:
+            used_options["used_genotype_frequency"]=genotype_frequency(panel_data, used_sample_indices)
+        used_options["profiler"]=prof
+        used_options["recombinator"]=recombinator
+
+    # Collapse identical panel samples. Do this after calculating frequencies, which should 
+    # still count every sample. N_samples stays the same, so transitions are unchanged. 
+    if options.get("dedup"):
+        with prof.stage("dedup"):
+            keep, multiplicity, groups = pre.collapse_duplicates(panel_data, used_sample_indices, options["populations"])
+            prof.count("collapsed_samples", len(used_sample_indices)-len(keep))
+            used_sample_indices=used_sample_indices[keep]
+            used_options["panel_multiplicity"]=multiplicity
+            used_options["panel_groups"]=groups
+
+    # Skip snps which carry no information. The transition between the snps either side
+    # of a run of skipped snps covers the whole run, since recombination distances add up. 
+    # Then the calculator gets a (smaller) copy of the panel. 
+    used_positions=data["snp_pos"]
+    calculated_data, calculated_observations, calculated_columns = panel_data, observations, used_sample_indices
+    if options.get("skip"):
+        with prof.stage("skip"):
+            kept_sites=algorithm.informative_sites(panel_data, observations, used_sample_indices)
+            n_kept=kept_sites.sum()
+            prof.count("skipped_snps", N_snps-n_kept)
+            used_positions=[p for p,k in zip(data["snp_pos"], kept_sites) if k]
+            calculated_data=panel_data[np.ix_(kept_sites, used_sample_indices)]
+            calculated_columns=None
+            calculated_observations=observations[kept_sites]
+            used_options["used_genotype_frequency"]=used_options["used_genotype_frequency"][kept_sites]
+            used_options["traceback_lookback_k"]=min(options["traceback_lookback_k"], n_kept)
 
-    used_genotype_frequency=None
-    used_options=options.copy()
-    used_genotype_data_na=used_genotype_data.astype(float)
-    used_genotype_data_na[used_genotype_data_na>2.0]=np.nan
-    used_genotype_frequency=np.nanmean(used_genotype_data_na,axis=1)/2
-    used_options["used_genotype_frequency"]=used_genotype_frequency
+    # Streaming, the calculator reads the panel a block at a time, reading ahead in the background. 
+    # --skip and --two_pass copy the parts of the panel they use. 
+    if options.get("stream") and calculated_columns is not None and not options.get("two_pass"):
+        calculated_data=io.row_reader(panel_data)
 
-    trans=algorithm.transition( N_samples, options["Ne"], recombinator, data["snp_pos"])
+    if options.get("skip"):
+        trans=algorithm.transition( N_samples, options["Ne"], recombinator, used_positions)
+    else:
+        trans=get_transition(algorithm, N_samples, options, recombinator, used_positions, data.get("chrom"))
     emiss=algorithm.emission(N_samples, options)
     if options["pseudo_haploid"]:
         emiss=algorithm.pseudohaploid_emission(N_samples, options)
-    vit=algorithm.calculator(used_genotype_data, trans, emiss, observations, used_options)
+    if options.get("two_pass"):
+        make_transition=lambda positions: algorithm.transition(N_samples, options["Ne"], recombinator, positions)
+        vit=two_pass.calculator(algorithm.calculator, make_transition, emiss, calculated_data, calculated_observations, 
+                                used_positions, used_options, calculated_columns)
+    else:
+        vit=algorithm.calculator(calculated_data, trans, emiss, calculated_observations, used_options, calculated_columns)
+
+    with prof.stage("calculate"):
+        vit.calculate()
+    for counter, n in vit.counters.items():
+        prof.count(counter, n)
 
-    vit.calculate()
-    out = summary_function(vit, used_sample_indices, data["snp_pos"], options, used_genotype_data, observations, i ) 
+    if options.get("skip"):
+        vit=algorithm.expanded_calculator(vit, kept_sites, data["snp_pos"])
 
-    if "multi_process" in options: # This is a bit of a hack to get some output from the multiprocess. 
-        print "\033[1ACompleted: "+str(data["sample_names"].index(sample_name))+"/"+str(len(data["sample_names"]))
+    out = summary_function(vit, used_sample_indices, data["snp_pos"], used_options, panel_data, observations, i ) 
+
+    # Check the two pass result against a full run
+    if options.get("two_pass_check"):
+        with prof.stage("two_pass_check"):
+            full_vit=algorithm.calculator(calculated_data, trans, emiss, calculated_observations, used_options, calculated_columns)
+            full_vit.calculate()
+            if options.get("skip"):
+                full_vit=algorithm.expanded_calculator(full_vit, kept_sites, data["snp_pos"])
+            full_out=summary_function(full_vit, used_sample_indices, data["snp_pos"], used_options, panel_data, observations, i)
+            prof.count("two_pass_checked_snps", N_snps)
+            prof.count("two_pass_agreeing_snps", sum(sorted(a)==sorted(b) for a, b in zip(out["local_ancestry"], full_out["local_ancestry"])))
+    out["profile"]=prof.summary()
 
     return out
 
 ##########################################################################################################
 
+def genotype_frequency(genotype_data, columns=None):
+    """
+    Allele frequency at each snp in the panel (columns of genotype_data, or all of them), 
+    ignoring missing (3) genotypes. nan if everything is missing.
+    """
+    frequency=np.zeros(len(genotype_data))
+    for start, end, block in panel_blocks(genotype_data, columns):
+        observed=block<3
+        counts=np.sum(observed, axis=1)
+        frequency[start:end]=np.sum(np.where(observed, block, 0), axis=1)/np.maximum(counts, 1)/2
+        frequency[start:end][counts==0]=np.nan
+    return frequency
+
+##########################################################################################################
+
+def chromosome_blocks(data):
+    """
+    Split the snps into contiguous blocks, one for each chromosome, as (chrom, start, end).
+    If we don't know the chromosomes, it's just one block with chrom None. 
+    """
+    if data.get("snp_chrom") is None or len(data["snp_chrom"])==0:
+        return [(None, 0, len(data["snp_pos"]))]
+
+    blocks=[]
+    start=0
+    chroms=data["snp_chrom"]
+    for t in range(1, len(chroms)+1):
+        if t==len(chroms) or chroms[t]!=chroms[start]:
+            if chroms[start] in [b[0] for b in blocks]:
+                raise Exception("Snps for chromosome %s are not together. Sort the input by chromosome" % chroms[start])
+            blocks.append((chroms[start], start, t))
+            start=t
+
+    return blocks
+
+##########################################################################################################
+
+def chromosome_data(data, block, in_memory=False):
+    """
+    The part of data for one chromosome block. Arrays are views, so this doesn't copy
+    anything, unless in_memory, in which case memory mapped arrays are read in. 
+    """
+    chrom, start, end = block
+    if chrom is None:
+        return data
+
+    chrom_data=dict(data)
+    chrom_data["chrom"]=chrom
+    for what in ["genotype_data", "query_genotype_data", "snp_pos", "snp_names", "snp_chrom", 
+                 "frequency", "closest_weights", "map_interval"]:
+        if what in data:
+            chrom_data[what]=data[what][start:end]
+            if in_memory and isinstance(chrom_data[what], np.memmap):
+                chrom_data[what]=np.array(chrom_data[what])
+
+    return chrom_data
+
+##########################################################################################################
+
+def combine_chromosome_results(outs):
+    """
+    Join up the results for each chromosome of one sample, in order
+    """
+    if len(outs)==1:
+        return outs[0]
+
+    combined={"local_ancestry":[], "best_parents":[], "profile":{"stages":[], "counters":{}}}
+    for out in outs:
+        combined["local_ancestry"]+=out["local_ancestry"]
+        combined["best_parents"]+=out["best_parents"]
+        combined["profile"]["stages"]+=out["profile"]["stages"]
+        for counter, n in out["profile"]["counters"].items():
+            if counter=="states":
+                combined["profile"]["counters"][counter]=max(n, combined["profile"]["counters"].get(counter, 0))
+            else:
+                combined["profile"]["counters"][counter]=n+combined["profile"]["counters"].get(counter, 0)
+
+    return combined
+
+##########################################################################################################
+
+def run_for_one_sample_by_chromosome(sample_name, data, recomb, options, summary_function):
+    """
+    Run one sample on each chromosome in turn, and combine the results
+    """
+    outs=[run_for_one_sample((sample_name, chromosome_data(data, block), get_recombinator(recomb, block[0]), 
+                              options, summary_function)) for block in chromosome_blocks(data)]
+    return combine_chromosome_results(outs)
+
+##########################################################################################################
+
 def calculate_full_matrix(data, samples_to_run, recomb, options, summary_function):
     """
     Calculate the full relatedness matrix for all the samples.
-    Can use multiple processes
+    Can use multiple processes. Each sample is run separately for each 
+    chromosome, and the results joined up at the end. With checkpointing, 
+    samples which already have a checkpoint are loaded rather than run. In 
+    safe mode, samples which fail are retried and then reported. 
     """
     
     if( options.get("safe", False) ):
@@ -226,29 +510,307 @@ def calculate_full_matrix(data, samples_to_run, recomb, options, summary_functio
     else:
         nn_function=run_for_one_sample
 
+    # Chromosome by chromosome, so that we only need one chromosome's data at a time
+    blocks=chromosome_blocks(data)
+    tasks=[(sample, block) for block in blocks for sample in samples_to_run]
+
+    results={}
+    if options.get("checkpoint"):
+        fingerprint=io.checkpoint_fingerprint(options)
+        for sample, block in tasks:
+            result=io.load_checkpoint(io.checkpoint_file(options, sample, block[0]), block[2]-block[1], fingerprint)
+            if result:
+                results[(sample, block)]=result
+        if results:
+            print "Resuming: found checkpoints for %d/%d samples" % (len(results), len(tasks))
+
+    remaining=[t for t in tasks if t not in results]
+    attempts=1+options["retries"] if options.get("safe", False) else 1
+    for attempt in range(attempts):
+        if not remaining:
+            break
+        if attempt:
+            print "Retrying %d failed samples (attempt %d/%d)\n" % (len(remaining), attempt+1, attempts)
+        results.update(run_samples(nn_function, data, remaining, recomb, options, summary_function))
+        remaining=[t for t in remaining if results[t] is None]
+
+    if remaining:
+        failed=[task_name(task) for task in remaining]
+        raise Exception("Failed to run %d samples: %s" % (len(failed), ", ".join(failed)))
+
+    return dict((sample, combine_chromosome_results([results[(sample, block)] for block in blocks])) 
+                for sample in samples_to_run)
+
+##########################################################################################################
+
+def task_name(task):
+    """
+    Name of a (sample, chromosome block) task, for progress and error messages
+    """
+    sample, block = task
+    return sample if block[0] is None else sample+":"+block[0]
+
+##########################################################################################################
+
+def init_worker(data, recomb, options, nn_function, summary_function):
+    """
+    Pool initializer - keep everything that is the same for every task in the worker, 
+    so that tasks only need to say which sample and chromosome to run. Processes are 
+    forked with the arguments, so the data is not copied. Also make sure the algorithm 
+    module is loaded before the first task. 
+    """
+    worker_state.update({"data":data, "recomb":recomb, "options":options, "nn_function":nn_function, 
+                         "summary_function":summary_function})
+    worker_state.setdefault("recombinators", {})
+    worker_state.setdefault("transitions", {})
+    __import__(algo_defs[options["algorithm"]])
+
+##########################################################################################################
+
+def run_worker_task(args):
+    """
+    Run one (sample, chromosome block) task in a pool worker, returning its index with 
+    the result, so that results can come back in any order. 
+    """
+    (index, (sample, block)) = args
+    return index, worker_state["nn_function"]((sample, chromosome_data(worker_state["data"], block), 
+                        get_recombinator(worker_state["recomb"], block[0]), worker_state["options"], 
+                        worker_state["summary_function"]))
+
+##########################################################################################################
+
+def get_recombinator(recomb, chrom):
+    """
+    The recombinator for one chromosome. In a pool worker, keep it for the next task. 
+    """
+    if "recombinators" not in worker_state:
+        return rec.for_chromosome(recomb, chrom)
+
+    if chrom not in worker_state["recombinators"]:
+        worker_state["recombinators"][chrom]=rec.for_chromosome(recomb, chrom)
+    return worker_state["recombinators"][chrom]
+
+##########################################################################################################
+
+def get_transition(algorithm, N_samples, options, recombinator, positions, chrom):
+    """
+    Transition probabilities for a panel of N_samples over positions. In a pool worker, 
+    every sample run on the whole of a chromosome with the same panel size has the same 
+    transitions, so keep them (and the probabilities they cache) for the next sample.
+    The number of positions and the first and last ones are part of the key, in case 
+    a sample is run on different snps. 
+    """
+    if "transitions" not in worker_state:
+        return algorithm.transition(N_samples, options["Ne"], recombinator, positions)
+
+    key=(algorithm.__name__, chrom, N_samples, len(positions), positions[0], positions[-1])
+    if key not in worker_state["transitions"]:
+        worker_state["transitions"][key]=algorithm.transition(N_samples, options["Ne"], recombinator, positions)
+    return worker_state["transitions"][key]
+
+##########################################################################################################
+
+def run_samples(nn_function, data, tasks, recomb, options, summary_function):
+    """
+    Run nn_function for each (sample, chromosome block) task, in parallel (processes 
+    or threads) if required. Returns a dictionary of results, keyed by task. In parallel, tasks are handed out 
+    one at a time, most expensive first, so that no worker is left with the slow ones 
+    at the end, and progress is reported as they finish. Running on one process, the 
+    next chromosome is read in while we work on the current one. 
+    """
+
     info=summary_function.__doc__.strip()
 
-    if options.get("multi_process",0)>1:
-        mp = options["multi_process"]
-        print info +" using %d processes\n" %(mp)
-        pool = Pool(mp)
-        args = [ (s, data, recomb, options, summary_function) for s in samples_to_run ]
-        pool_results=pool.map(nn_function, args, mp )
-        results=dict(zip(samples_to_run, pool_results))
+    if options.get("multi_process",0)>1 or options.get("threads",0)>1:
+        costs=[estimate_cost(s, chromosome_data(data, block), options) for s, block in tasks]
+        order=sorted(range(len(tasks)), key=lambda i: -costs[i])
+        args = ( (i, tasks[i]) for i in order )
+        worker_args = (data, recomb, options, nn_function, summary_function)
+
+        # Load the algorithm here, so that forked processes start with it
+        __import__(algo_defs[options["algorithm"]])
+
+        # Threads share the data, and the calculator runs without the gil
+        if options.get("threads",0)>1:
+            print info +" using %d threads\n" %(options["threads"])
+            pool = ThreadPool(options["threads"], init_worker, worker_args)
+        else:
+            print info +" using %d processes\n" %(options["multi_process"])
+            pool = Pool(options["multi_process"], init_worker, worker_args)
+
+        results={}
+        progress=profiling.progress_meter(len(tasks), sum(costs))
+        try:
+            for i, result in pool.imap_unordered(run_worker_task, args):
+                results[tasks[i]]=result
+                progress.update(task_name(tasks[i]), costs[i])
+        finally:
+            worker_state.clear()    # Threads set it up in this process
+        pool.close()
+        pool.join()
     else:
         print info + ":\n"
         results = {}
-        for i, sample in enumerate(samples_to_run):
-            print "\033[1A"+sample+" ["+str(i+1)+"/"+str(len(samples_to_run))+"]"
-            results[sample] = nn_function((sample, data, recomb, options, summary_function))
+        blocks=[]
+        for sample, block in tasks:
+            if block not in blocks: 
+                blocks.append(block)
+        loaded=((block, chromosome_data(data, block, in_memory=not options.get("stream")), rec.for_chromosome(recomb, block[0])) 
+                for block in blocks)
 
-    return results    
+        i=0
+        for block, block_data, block_recomb in io.prefetch(loaded):
+            for sample in [s for s, b in tasks if b==block]:
+                i+=1
+                print "\033[1A"+task_name((sample, block))+" ["+str(i)+"/"+str(len(tasks))+"]"
+                results[(sample, block)] = nn_function((sample, block_data, block_recomb, options, summary_function))
+
+    return results
 
 ##########################################################################################################
 
+def panel_size(sample_name, data, options):
+    """
+    Number of panel samples used for one sample, after --panel and --closest
+    """
+    if "panel" in options:
+        n_panel=len(set(options["panel"]) & set(data["sample_names"]))
+        n_panel-=sample_name in options["panel"]
+    else:
+        n_panel=len(data["sample_names"])-(sample_name in data["sample_names"])
+    if "closest" in options:
+        n_panel=min(n_panel, options["closest"])
 
-def main(options):
+    return n_panel
+
+##########################################################################################################
+
+def estimate_cost(sample_name, data, options):
+    """
+    Rough relative cost of running one sample: number of states (panel size squared, 
+    after --panel and --closest) times the number of snps (that are not missing in the 
+    sample, with --skip).
+    """
+    n_panel=panel_size(sample_name, data, options)
+
+    n_snps=len(data["snp_pos"])
+    if options.get("skip"):
+        if sample_name in data.get("query_names", []):
+            observations=data["query_genotype_data"][:,data["query_names"].index(sample_name)]
+        else:
+            observations=data["genotype_data"][:,data["sample_names"].index(sample_name)]
+        n_snps=max(1, np.sum(np.asarray(observations)!=3))
+
+    return n_panel*(n_panel-1)//2*n_snps
+
+##########################################################################################################
+
+def estimate_memory(n_snps, n_panel, tbk, buffer_size):
+    """
+    Rough peak memory, in bytes, of running one sample on n_snps snps with a panel of 
+    n_panel samples, using a traceback chunk of tbk snps and a sparse buffer of buffer_size 
+    elements. The panel itself is shared, and not counted. Returns a dictionary of the main parts.
+    """
+    n_states=n_panel*(n_panel-1)//2
+    return {"data":     16*n_snps,                                   # Observations and frequencies
+            "states":   8*(8*n_states+n_panel*n_panel),              # Viterbi vectors, state lookups
+            "chunk":    8*2*tbk*n_states,                            # Traceback chunk, and its dense copy in traceback()
+            "buffer":   8*3*buffer_size,                             # Sparse triplet buffers
+            "traceback":traceback_entry_bytes*n_snps*n_states}       # Sparse traceback matrix
+
+##########################################################################################################
+
+def plan_memory(data, samples_to_run, options):
+    """
+    Choose the number of processes (or threads, with --threads), traceback chunk size 
+    (--tbk) and sparse buffer size so that the run fits in options["max_memory"] Mb. The 
+    chunk size changes the results slightly, so it is only reduced if one worker doesn't 
+    fit. Otherwise, use as many workers as fit, with the biggest buffers, which are 
+    faster. The sparse traceback matrix usually dominates, and can only be made smaller 
+    by using fewer snps (per chromosome) or a smaller panel. Updates options and prints 
+    the plan. 
+    """
+    budget=options["max_memory"]*1024*1024
+    n_snps=max(end-start for chrom, start, end in chromosome_blocks(data))
+    n_panel=max([panel_size(s, data, options) for s in samples_to_run]+[2])
+    threads=options.get("threads")
+
+    # Workers share the main copy of the input: threads directly, and processes because they are 
+    # forked with it (see init_worker)
+    main_bytes=process_overhead_bytes
+    if isinstance(data["genotype_data"], np.ndarray) and not isinstance(data["genotype_data"], np.memmap):
+        main_bytes+=data["genotype_data"].nbytes
+
+    # With threads or one process, samples run in the main process
+    worker_bytes=lambda workers: process_overhead_bytes if workers>1 and not threads else 0
+
+    max_workers=threads or options.get("multi_process", cpu_count())
+    max_tbk=options["traceback_lookback_k"]
+    tbks=[max_tbk]+[t for t in [50, 20, 10] if t<max_tbk]
+    algorithm=__import__(algo_defs[options["algorithm"]])
+    max_buffer=int(min(algorithm.max_num_sparse_elems, n_snps*n_panel*(n_panel-1)//2+1))
+    buffer_sizes=[max_buffer]+[b for b in [100000, 10000] if b<max_buffer]
+
+    # Smallest settings, in case nothing fits
+    plan=(1, tbks[-1], buffer_sizes[-1])
+    fits=[(workers, tbk, buffer_size) for tbk in tbks for workers in range(max(max_workers,1), 0, -1) 
+          for buffer_size in buffer_sizes 
+          if main_bytes+workers*(worker_bytes(workers)+sum(estimate_memory(n_snps, n_panel, tbk, buffer_size).values()))<=budget]
+    if fits:
+        plan=fits[0]
+
+    workers, tbk, buffer_size = plan
+    memory=estimate_memory(n_snps, n_panel, tbk, buffer_size)
+    per_worker=worker_bytes(workers)+sum(memory.values())
+    total=main_bytes+workers*per_worker
+    worker_name="thread" if threads else "process"
+
+    options["threads" if threads else "multi_process"]=workers
+    options["traceback_lookback_k"]=tbk
+    options["sparse_buffer_size"]=buffer_size
+
+    mb=1024*1024
+    print "Memory plan for %d Mb: %d %s%s, --tbk %d, sparse buffer of %d elements" % (options["max_memory"], 
+                workers, worker_name, "" if workers==1 else "s" if threads else "es", tbk, buffer_size)
+    if tbk!=max_tbk:
+        print "Note: reduced --tbk from %d to %d, which changes the results slightly" % (max_tbk, tbk)
+    print "Estimated %1.0f Mb per %s (traceback %1.0f Mb, for up to %d snps and %d panel samples), %1.0f Mb in total" % (
+                per_worker/mb, worker_name, memory["traceback"]/mb, n_snps, n_panel, total/mb)
+    if total>budget:
+        print "Warning: this probably does not fit in %d Mb. Use fewer snps (-x), a smaller panel (-n/-c) or split by chromosome" % options["max_memory"]
+    print
+
+##########################################################################################################
 
+def shard_samples(data, samples_to_run, options):
+    """
+    Split the samples into N shards so that each shard has roughly the same total 
+    cost: take samples most expensive first and give each one to the cheapest shard 
+    so far. Deterministic, so every shard of an array job agrees on the split. 
+    Returns this shard's samples, in their original order. 
+    """
+    shard, n_shards=options["shard"]
+    costs=[estimate_cost(s, data, options) for s in samples_to_run]
+    order=sorted(range(len(samples_to_run)), key=lambda i: -costs[i])
+
+    loads=[0]*n_shards
+    assigned=[None]*len(samples_to_run)
+    for i in order:
+        which=loads.index(min(loads))
+        assigned[i]=which
+        loads[which]+=costs[i]
+
+    shard_indices=[i for i in range(len(samples_to_run)) if assigned[i]==shard-1]
+    print "Shard %d/%d: %d/%d samples, %1.1f%% of the estimated cost" % (shard, n_shards, len(shard_indices), 
+                len(samples_to_run), 100*loads[shard-1]/max(1,sum(loads)))
+    return shard_indices
+
+##########################################################################################################
+
+def load_data(options):
+    """
+    Load the genotype data from whichever source was specified
+    """
     if options.get("test_file"):
        data = io.load_minimal_data(options["test_file"])
     elif options.get("vcf_file"):
@@ -257,38 +819,219 @@ def main(options):
         data = io.load_eigenstrat_data(options["eigenstrat_root"])
     else:
         raise Exception("No input file specified")
-    
-    recomb = rec.get_recombinator(options["recombination_map"])
 
-    if options["pseudo_haploid"] and np.any(np.equal(data["genotype_data"], 1)):
+    return data
+
+##########################################################################################################
+
+def preprocess_data(data, options):
+    """
+    Check the data is consistent with the options, cut it down if required
+    and turn it into an array. Returns the list of samples to run. 
+    """
+    # With a panel index, we already know about the panel, so just check the queries
+    if "has_heterozygotes" in data:
+        has_heterozygotes=data["has_heterozygotes"] or np.any(np.equal(data.get("query_genotype_data", []), 1))
+    else:
+        has_heterozygotes=np.any(np.equal(data["genotype_data"], 1))
+
+    if options["pseudo_haploid"] and has_heterozygotes:
         raise Exception("Cannot use pseudohaploid algorithm on data with hetozygote sites. "+
                         "Pseudohaploids should be coded as 0 and 2.")
 
-    if not options["pseudo_haploid"] and not np.any(np.equal(data["genotype_data"], 1)):
+    if not options["pseudo_haploid"] and not has_heterozygotes:
         raise Exception("All your data is 0 or 2. Are you sure you don't want the pseudohaploid "+
                         "algorithm (-s)?")
     
-    # Cut down data if specified, and turn into an array
+    # Cut down data if specified, and turn into an array of uint8. Memory mapped arrays from an index are already uint8, so are left alone.
     max_snps = options.get("max_snps",None)
+    if max_snps and "has_heterozygotes" in data:
+        raise Exception("Can't cut down the number of snps with a panel index - build the index with -x instead")
     if max_snps:
         data["snp_names"]=data["snp_names"][0:max_snps]
         data["snp_pos"]=data["snp_pos"][0:max_snps]
+        if "snp_chrom" in data:
+            data["snp_chrom"]=data["snp_chrom"][0:max_snps]
         data["genotype_data"]=data["genotype_data"][0:max_snps]
-    data["genotype_data"] = array(data["genotype_data"])
-    options["missing_probability"]=np.mean(data["genotype_data"]==3)
+    data["genotype_data"] = np.asarray(data["genotype_data"], dtype=np.uint8)
+
+    if "n_missing" in data:
+        n_missing=data["n_missing"]
+        if "query_genotype_data" in data:
+            n_missing+=np.sum(data["query_genotype_data"]==3)
+        n_samples=len(data["sample_names"])+len(data.get("query_names", []))
+        options["missing_probability"]=n_missing/(len(data["snp_pos"])*n_samples)
+    else:
+        options["missing_probability"]=np.mean(data["genotype_data"]==3)
     if options["missing_probability"]>0:
         print "Found "+str(int(np.round(options["missing_probability"]*100))) + "% missing genotypes"
     
-    samples_to_run=data["sample_names"]
+    samples_to_run=data.get("query_names", data["sample_names"])
     if options.get("individual", None):
         samples_to_run=options["individual"]
 
-    # Phasing
-    results=calculate_full_matrix(data, samples_to_run, recomb, options, ancestry.ancestry_n_tracebacks)
-    io.output_phased_data(results, samples_to_run, data["snp_names"], options)
-        
+    return samples_to_run
+
+##########################################################################################################
+
+def load_inputs(options):
+    """
+    Load the data and the recombinator, either from the input files, or from
+    a panel index plus query samples from the input files. When serving, there 
+    might not be any query samples. 
+    """
+    if options.get("index"):
+        data=io.load_panel_index(options["index"])
+        if not options.get("serve"):
+            io.add_query_data(data, load_data(options))
+        options["populations"]=data["populations"]
+        recomb = rec.indexed_recombinator(data["snp_pos"], data["map_interval"], data.get("snp_chrom"))
+    else:
+        data=load_data(options)
+        recomb = rec.get_recombinator(options["recombination_map"])
+
+    return data, recomb
+
+##########################################################################################################
+
+def run(panel_genotypes, positions, populations, query_genotypes, recombination_map=1.0, chromosomes=None, **params):
+    """
+    Run lace on numpy arrays, without reading or writing any files or printing anything.
+    panel_genotypes is an (snps x panel samples) array of 0, 1, 2 or 3 (missing), positions are
+    the snp positions, populations has one label per panel sample, and query_genotypes is
+    (snps x query samples), or one query sample as a vector. recombination_map is a constant
+    rate in cM/Mb, a map file (with {chrom} for one per chromosome), or a recombinator. If
+    chromosomes (one per snp) are given, each chromosome is run separately. Any other option (e.g. Ne, pseudo_haploid,
+    n_traceback_paths, closest, dedup) can be given as a keyword argument. 
+    Returns a dictionary with "local_ancestry" - (query samples x snps x 2) indices into 
+    "population_labels" - and "best_parents" - (query samples x snps x 2) panel sample indices.
+    """
+    options=default_options()
+    for param, value in params.items():
+        if param not in options and param not in ["closest", "dedup", "everything", "skip", "two_pass"]:
+            raise Exception("Unknown option " + param)
+        options[param]=value
+
+    panel_genotypes=np.asarray(panel_genotypes, dtype=np.uint8)
+    query_genotypes=np.asarray(query_genotypes, dtype=np.uint8)
+    if query_genotypes.ndim==1:
+        query_genotypes=query_genotypes.reshape(-1,1)
+    if not len(panel_genotypes)==len(query_genotypes)==len(positions):
+        raise Exception("Panel, queries and positions have different numbers of snps")
+    if len(populations)!=panel_genotypes.shape[1]:
+        raise Exception("Need one population label for each panel sample")
+
+    has_heterozygotes=np.any(panel_genotypes==1) or np.any(query_genotypes==1)
+    if options["pseudo_haploid"] and has_heterozygotes:
+        raise Exception("Cannot use pseudohaploid algorithm on data with hetozygote sites")
+
+    if hasattr(recombination_map, "distance"):
+        recomb=recombination_map
+    elif isinstance(recombination_map, str) and "{chrom}" in recombination_map:
+        recomb=rec.chromosome_recombinator(recombination_map)
+    elif isinstance(recombination_map, str):
+        recomb=rec.recombinator(recombination_map)
+    else:
+        recomb=rec.constant_recombinator(float(recombination_map))
+
+    labels=sorted(set(populations))
+    label_index=dict((label, j) for j, label in enumerate(labels))
+    options["populations"]=list(populations)
+    n_missing=np.sum(panel_genotypes==3)+np.sum(query_genotypes==3)
+    options["missing_probability"]=n_missing/(len(positions)*(panel_genotypes.shape[1]+query_genotypes.shape[1]))
+
+    data={"sample_names":["panel%d" % j for j in range(panel_genotypes.shape[1])], "snp_chrom":chromosomes,
+          "snp_pos":list(positions), "genotype_data":panel_genotypes,
+          "query_names":["query%d" % j for j in range(query_genotypes.shape[1])],
+          "query_genotype_data":query_genotypes}
+
+    n_queries=query_genotypes.shape[1]
+    local_ancestry=np.zeros((n_queries, len(positions), 2), dtype=np.int32)
+    best_parents=np.zeros((n_queries, len(positions), 2), dtype=np.int32)
+    for j, query_name in enumerate(data["query_names"]):
+        out=run_for_one_sample_by_chromosome(query_name, data, recomb, options, ancestry.ancestry_n_tracebacks)
+        local_ancestry[j]=[(label_index[a1], label_index[a2]) for a1, a2 in out["local_ancestry"]]
+        best_parents[j]=out["best_parents"]
+
+    return {"local_ancestry":local_ancestry, "best_parents":best_parents, "population_labels":labels}
+
+##########################################################################################################
+
+def build_panel_index(options):
+    """
+    Build a panel index from the input data (restricted to the -n panel if specified)
+    and the recombination map, and save it to options["build_index"].
+    """
+    data=load_data(options)
+    preprocess_data(data, options)
+    populations=options["populations"]
+
+    if "panel" in options:
+        include=np.in1d(np.array(data["sample_names"]), np.array(options["panel"]))
+        data["sample_names"]=[s for s,inc in zip(data["sample_names"], include) if inc]
+        data["genotype_data"]=data["genotype_data"][:,include]
+        populations=[p for p,inc in zip(populations, include) if inc]
+
+    recomb = rec.get_recombinator(options["recombination_map"])
+    map_intervals=rec.map_intervals(recomb, data["snp_pos"], data.get("snp_chrom"))
+    frequency=genotype_frequency(data["genotype_data"])
+    closest_weights=pre.frequency_weights(data["genotype_data"])
+
+    io.write_panel_index(options["build_index"], data, populations, map_intervals, frequency, closest_weights)
+    print "Wrote panel index with %d samples and %d snps to %s" % (len(data["sample_names"]), len(data["snp_pos"]), options["build_index"])
+
+##########################################################################################################
+
+def main(options):
+
+    if options.get("build_index"):
+        build_panel_index(options)
+        return
+
+    prof=profiling.profiler()
+
+    with profiling.cprofile_to(options["profile"]+".main.prof" if options.get("cprofile") else None):
+        with prof.stage("input"):
+            data, recomb = load_inputs(options)
+
+        with prof.stage("preprocess"):
+            samples_to_run=preprocess_data(data, options)
+        if options.get("shard"):
+            shard_indices=shard_samples(data, samples_to_run, options)
+            io.write_shard_samples(options, shard_indices, samples_to_run)
+            samples_to_run=[samples_to_run[i] for i in shard_indices]
+            options["out"]=io.shard_root(options["out"], *options["shard"])
+        prof.count("snps", len(data["snp_pos"]))
+        prof.count("samples", len(samples_to_run))
+        if options.get("max_memory") and samples_to_run:
+            plan_memory(data, samples_to_run, options)
+
+        # Phasing
+        with prof.stage("samples"):
+            results=calculate_full_matrix(data, samples_to_run, recomb, options, ancestry.ancestry_n_tracebacks)
+        with prof.stage("output"):
+            if samples_to_run:
+                io.output_phased_data(results, samples_to_run, data["snp_names"], options)
+
+    if options.get("two_pass_check"):
+        counters=[results[s]["profile"]["counters"] for s in samples_to_run if "profile" in results[s]]
+        checked=sum(c.get("two_pass_checked_snps", 0) for c in counters)
+        agreeing=sum(c.get("two_pass_agreeing_snps", 0) for c in counters)
+        print "Two pass local ancestry agrees with a full run at %d/%d (%1.2f%%) snps" % (agreeing, checked, 100*agreeing/max(checked, 1))
+
+    if options.get("profile"):
+        sample_profiles=dict((s, results[s]["profile"]) for s in samples_to_run if "profile" in results[s])
+        profiling.write_report(options["profile"], prof.summary(), sample_profiles, options)
+        print "Wrote profile report to " + options["profile"]
+
 ##########################################################################################################
 
 if __name__ == "__main__" :
     options = parse_options()
-    main(options)
+    if options.get("merge"):
+        io.merge_shards(options)
+    elif options.get("serve"):
+        import lace_server
+        lace_server.serve(options)
+    else:
+        main(options)
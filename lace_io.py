@@ -19,10 +19,13 @@
 # Input/output functions for the nearest_neighbour script.
 
 from __future__ import division
-import sys, getopt, gzip
+import sys, getopt, gzip, os, json, urllib, threading, Queue, hashlib, itertools
 from math import exp, log, fsum
 import numpy as np
 
+# Number of snps that row_reader reads at a time
+reader_block_snps = 10000
+
 ##########################################################################################################
 
 def parse_individual(arg):
@@ -133,12 +136,13 @@ def load_eigenstrat_data(file_root):
     snp_data=snp_file.readlines()
     snp_data=[x.strip() for x in snp_data]
     snp_names=[x.split()[0] for x in snp_data]
+    snp_chrom=[x.split()[1] for x in snp_data]
     snp_pos=[int(x.split()[3]) for x in snp_data]
     snp_file.close()
 
-    genotype_data=np.genfromtxt(file_root+".geno", dtype=np.int, delimiter=1)
+    genotype_data=np.genfromtxt(file_root+".geno", dtype=np.uint8, delimiter=1)
     genotype_data[genotype_data==9]=3
-    return {"sample_names":sample_names, "snp_names":snp_names, "snp_pos":snp_pos, "genotype_data":genotype_data}
+    return {"sample_names":sample_names, "snp_names":snp_names, "snp_chrom":snp_chrom, "snp_pos":snp_pos, "genotype_data":genotype_data}
 
     
 ##########################################################################################################
@@ -155,6 +159,7 @@ def load_vcf_data(vcf_file):
         vcf_data=open(vcf_file, "r")
         
     snp_names=[]
+    snp_chrom=[]
     snp_pos=[]
     genotype_data=[]
 
@@ -185,6 +190,7 @@ def load_vcf_data(vcf_file):
             else:
                 snp_names.append(data[0]+":"+data[1])
 
+            snp_chrom.append(data[0])
             snp_pos.append(int(data[1]))
 
             if not all([(x[0]=="." and x[2]==".") or (x[0] in ["0", "1"] and x[2] in ["0", "1"]) for x in data[9:]]):
@@ -192,7 +198,7 @@ def load_vcf_data(vcf_file):
             
             genotype_data.append([ 3 if x[0]=="." and x[2]=="." else int(x[0])+int(x[2]) for x in data[9:] ])
 
-    return {"sample_names":sample_names, "snp_names":snp_names, "snp_pos":snp_pos, "genotype_data":genotype_data}
+    return {"sample_names":sample_names, "snp_names":snp_names, "snp_chrom":snp_chrom, "snp_pos":snp_pos, "genotype_data":genotype_data}
 
 ##########################################################################################################
 
@@ -215,6 +221,17 @@ def parents_to_string(parent_tuple):
 
 ##########################################################################################################
 
+def open_output(root, suffix, options, mode):
+    """
+    Open the output file {root}.{suffix}.txt - gzipped if we are outputting gzipped files
+    """
+    if(options.get("gzip", None)):
+        return gzip.open(root+"."+suffix+".txt.gz", mode)
+    else:
+        return open(root+"."+suffix+".txt", mode)
+
+##########################################################################################################
+
 def output_phased_data(phasing, sample_names, snp_names, options):
     """
     Output phased data - and quality scores. 
@@ -226,12 +243,7 @@ def output_phased_data(phasing, sample_names, snp_names, options):
     # Output phased data
     for suffix, tag, format_func in things_to_output:
 
-        if(options.get("gzip", None)):
-            file_name = options["out"]+"."+suffix+".txt.gz"
-            out_file = gzip.open(file_name, "w")
-        else:
-            file_name = options["out"]+"."+suffix+".txt"
-            out_file = open(file_name, "w")
+        out_file = open_output(options["out"], suffix, options, "w")
         
         #out_file.write( "\t".join(["POS"]+sample_names) + "\n" )
         for i in range(len(phasing[sample_names[0]][tag])):
@@ -243,3 +255,349 @@ def output_phased_data(phasing, sample_names, snp_names, options):
 
 ##########################################################################################################
 
+
+def checkpoint_file(options, sample_name, chrom=None):
+    """
+    Where the checkpoint for this sample (and chromosome) lives: one compressed .npz per 
+    sample and chromosome in the directory {out}.checkpoints. Names are quoted so they are 
+    safe as file names. 
+    """
+    name=urllib.quote(sample_name, safe="")
+    if chrom is not None:
+        name+="."+urllib.quote(chrom, safe="")
+    return os.path.join(options["out"]+".checkpoints", name+".npz")
+
+##########################################################################################################
+
+# Options which change the result for a sample, so a checkpoint is only reused if they are the same
+checkpoint_options = ["test_file", "vcf_file", "eigenstrat_root", "index", "max_snps", "panel", "populations", 
+                      "closest", "dedup", "pseudo_haploid", "Ne", "traceback_lookback_k", "mutation_probability", 
+                      "triple_het_weight", "n_traceback_paths", "everything", "skip", "two_pass", "algorithm", 
+                      "recombination_map", "window", "smooth_output", "generations"]
+
+def checkpoint_fingerprint(options):
+    """
+    A hash of the options that the result for a sample depends on
+    """
+    settings=dict((o, options.get(o)) for o in checkpoint_options)
+    return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+##########################################################################################################
+
+def save_checkpoint(file_name, result, fingerprint):
+    """
+    Save the phasing result for one sample, with the fingerprint of the options used. 
+    Written to a temporary file and then renamed so that a run killed half way through 
+    a write never leaves a truncated checkpoint. 
+    """
+    directory=os.path.dirname(file_name)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:         # Another process got there first
+            pass
+
+    tmp_name=file_name+".tmp.npz"
+    np.savez_compressed(tmp_name,
+                        local_ancestry=np.array(result["local_ancestry"]),
+                        best_parents=np.array(result["best_parents"], dtype=np.int64),
+                        profile=np.array(json.dumps(result.get("profile", {}))),
+                        fingerprint=np.array(fingerprint))
+    os.rename(tmp_name, file_name)
+
+##########################################################################################################
+
+def load_checkpoint(file_name, n_snps, fingerprint):
+    """
+    Load a result saved by save_checkpoint, or None if there isn't one, or if it is 
+    from a run with different settings (fingerprint) or a different number of snps, 
+    in which case the sample is run again. 
+    """
+    if not os.path.isfile(file_name):
+        return None
+
+    saved=np.load(file_name)
+    local_ancestry=[tuple(x) for x in saved["local_ancestry"].tolist()]
+    if "fingerprint" not in saved.files or str(saved["fingerprint"])!=fingerprint or len(local_ancestry)!=n_snps:
+        print "Checkpoint %s is from a run with different settings or data, running again" % file_name
+        saved.close()
+        return None
+
+    result={"local_ancestry":local_ancestry, 
+            "best_parents":[tuple(x) for x in saved["best_parents"].tolist()],
+            "profile":json.loads(str(saved["profile"]))}
+    saved.close()
+    return result
+
+##########################################################################################################
+
+def shard_root(out, shard, n_shards):
+    """
+    Output root for shard i of N
+    """
+    return "%s.shard%dof%d" % (out, shard, n_shards)
+
+##########################################################################################################
+
+def write_shard_samples(options, shard_indices, samples_to_run):
+    """
+    Record which samples are in this shard, and where they go in the full 
+    sample order, so that merge_shards can put them back together. 
+    """
+    out_file=open(shard_root(options["out"], *options["shard"])+".samples.txt", "w")
+    for i in shard_indices:
+        out_file.write("%d\t%s\n" % (i, samples_to_run[i]))
+    out_file.close()
+
+##########################################################################################################
+
+def merge_shards(options):
+    """
+    Merge the .la (and .bp) output of N shards into the normal output files, with
+    samples in the original order. Reads all the shards line by line together, so 
+    it doesn't need to hold anything in memory, and fails if the shards don't all have 
+    the same number of snps. 
+    """
+    n_shards=options["merge"]
+    roots=[shard_root(options["out"], i, n_shards) for i in range(1, n_shards+1)]
+
+    # Where each column of each shard goes in the merged output. 
+    positions=[]
+    for root in roots:
+        lines=open(root+".samples.txt").readlines()
+        positions.append([int(line.split("\t")[0]) for line in lines])
+    n_samples=sum(len(p) for p in positions)
+    if sorted(sum(positions, []))!=range(n_samples):
+        raise Exception("Shard sample lists don't add up to one set of samples. Missing or duplicated shards?")
+
+    suffixes=["la"]
+    if options.get("best_parents", None): suffixes.append("bp")
+    
+    used=[i for i in range(n_shards) if positions[i]] # Shards with no samples have no output
+    for suffix in suffixes:
+        in_files=[open_output(roots[i], suffix, options, "r") for i in used]
+        out_file=open_output(options["out"], suffix, options, "w")
+        
+        for lines in itertools.izip_longest(*in_files):
+            if None in lines:
+                short=[roots[i] for i, line in zip(used, lines) if line is None]
+                raise Exception("Shard output for %s has fewer snps than the other shards. Did the shard finish?" % ", ".join(short))
+            merged=[None]*n_samples
+            for i, line in zip(used, lines):
+                bits=line.split()
+                for j, where in enumerate(positions[i]):
+                    merged[where]=bits[2*j]+" "+bits[2*j+1]
+            out_file.write(" ".join(merged)+"\n")
+
+        for in_file in in_files: 
+            in_file.close()
+        out_file.close()
+
+    print "Merged %d shards into %s" % (n_shards, options["out"])
+
+##########################################################################################################
+
+def write_panel_index(index_dir, data, populations, map_intervals, frequency, closest_weights):
+    """
+    Save everything derived from a reference panel that doesn't depend on the query
+    samples, so that later runs can load it rather than parsing and processing the 
+    panel again. Genotypes are saved as a uint8 .npy so they can be memory mapped. 
+    """
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+
+    genotypes=np.asarray(data["genotype_data"], dtype=np.uint8)
+    np.save(os.path.join(index_dir, "genotypes.npy"), genotypes)
+    np.save(os.path.join(index_dir, "snp_pos.npy"), np.array(data["snp_pos"], dtype=np.int64))
+    np.save(os.path.join(index_dir, "map_interval.npy"), np.array(map_intervals, dtype=np.float64))
+    np.save(os.path.join(index_dir, "frequency.npy"), np.array(frequency, dtype=np.float64))
+    np.save(os.path.join(index_dir, "closest_weights.npy"), np.array(closest_weights, dtype=np.float64))
+
+    meta={"sample_names":data["sample_names"], "snp_names":data["snp_names"], "populations":populations,
+          "n_missing":int(np.sum(genotypes==3)), "has_heterozygotes":bool(np.any(genotypes==1))}
+    if "snp_chrom" in data:
+        meta["snp_chrom"]=data["snp_chrom"]
+    meta_file=open(os.path.join(index_dir, "meta.json"), "w")
+    json.dump(meta, meta_file)
+    meta_file.close()
+
+##########################################################################################################
+
+def load_panel_index(index_dir):
+    """
+    Load a panel index written by write_panel_index. The genotypes are memory mapped
+    so that only the parts that are used get read. Returns a data dictionary in the same 
+    form as the load_*_data functions, plus the precomputed panel summaries. 
+    """
+    meta_file=open(os.path.join(index_dir, "meta.json"), "r")
+    meta=json.load(meta_file)
+    meta_file.close()
+
+    data={"sample_names":[str(x) for x in meta["sample_names"]],
+          "snp_names":[str(x) for x in meta["snp_names"]],
+          "populations":[str(x) for x in meta["populations"]],
+          "n_missing":meta["n_missing"],
+          "has_heterozygotes":meta["has_heterozygotes"]}
+    if "snp_chrom" in meta:
+        data["snp_chrom"]=[str(x) for x in meta["snp_chrom"]]
+    data["genotype_data"]=np.load(os.path.join(index_dir, "genotypes.npy"), mmap_mode="r")
+    data["snp_pos"]=np.load(os.path.join(index_dir, "snp_pos.npy")).tolist()
+    if not os.path.isfile(os.path.join(index_dir, "map_interval.npy")):
+        raise Exception("Panel index %s is from an older version of lace. Rebuild it with --build_index" % index_dir)
+    for what in ["map_interval", "frequency", "closest_weights"]:
+        data[what]=np.load(os.path.join(index_dir, what+".npy"))
+
+    return data
+
+##########################################################################################################
+
+def add_query_data(panel, query):
+    """
+    Add query samples (a data dictionary from one of the load_*_data functions) to a
+    panel loaded with load_panel_index. The query data must have the same snps. 
+    """
+    if list(query["snp_pos"])!=list(panel["snp_pos"]):
+        raise Exception("Query data has different snps from the panel index")
+    if "snp_chrom" in query and "snp_chrom" in panel and query["snp_chrom"]!=panel["snp_chrom"]:
+        raise Exception("Query data has different chromosomes from the panel index")
+    overlap=set(query["sample_names"]) & set(panel["sample_names"])
+    if overlap:
+        raise Exception("Query samples are also in the panel index: " + ", ".join(sorted(overlap)))
+
+    panel["query_names"]=query["sample_names"]
+    panel["query_genotype_data"]=np.asarray(query["genotype_data"], dtype=np.uint8)
+
+##########################################################################################################
+
+def prefetch(iterable):
+    """
+    Iterate over iterable, getting the next item ready in a background thread while
+    the current one is being used. Use this to read the next block of data from disk
+    while we are working on the current one. 
+    """
+    ready=Queue.Queue(1)
+
+    def produce():
+        try:
+            for item in iterable:
+                ready.put((True, item))
+            ready.put((False, None))
+        except Exception as ex:
+            ready.put((False, ex))
+
+    producer=threading.Thread(target=produce)
+    producer.daemon=True
+    producer.start()
+
+    while True:
+        more, item=ready.get()
+        if not more:
+            break
+        yield item
+
+    producer.join()
+    if item is not None:
+        raise item
+
+##########################################################################################################
+
+class row_reader(object):
+    """
+    Read the rows (snps) of a genotype matrix a block at a time, in order, reading 
+    the next block in a background thread while the current one is used. source is 
+    either anything that can be sliced by rows - e.g. the memory mapped genotypes from 
+    a panel index - or an iterator of blocks of rows, which can only be read once, in 
+    which case n_rows has to be given. Slicing a row_reader by rows gives an array, 
+    and only the rows from the start of the last slice on are kept, so slices have to 
+    go forwards (or back to the beginning, for a source that can be sliced). 
+    """
+
+    def __init__(self, source, n_rows=None, block_size=reader_block_snps):
+        self.source=source
+        self.sliceable=hasattr(source, "__getitem__")
+        self.n_rows=len(source) if n_rows is None else n_rows
+        self.block_size=block_size
+        self.started=False
+        self.rewind()
+
+    def __len__(self):
+        return self.n_rows
+
+    def read_blocks(self):
+        """
+        Generate the blocks of rows from the source
+        """
+        if self.sliceable:
+            for start in range(0, self.n_rows, self.block_size):
+                yield np.array(self.source[start:start+self.block_size])
+        else:
+            for block in self.source:
+                yield np.asarray(block)
+
+    def read_next(self):
+        """
+        Start reading the next block in a background thread
+        """
+        self.next_block={}
+        def read():
+            try:
+                self.next_block["rows"]=next(self.blocks, None)
+            except Exception as ex:
+                self.next_block["error"]=ex
+        self.reader=threading.Thread(target=read)
+        self.reader.daemon=True
+        self.reader.start()
+
+    def rewind(self):
+        """
+        Go back to the first row
+        """
+        if self.started:
+            if not self.sliceable:
+                raise Exception("Can only read the rows from an iterator once")
+            self.reader.join()
+        self.blocks=self.read_blocks()
+        self.buffer=None
+        self.buffer_start=0
+        self.buffer_end=0
+        self.read_next()
+
+    def rows(self, start, end):
+        """
+        Rows start to end, as an array. 
+        """
+        if start<self.buffer_start:
+            self.rewind()
+        self.started=True
+
+        while self.buffer_end<end:
+            self.reader.join()
+            if "error" in self.next_block:
+                raise self.next_block["error"]
+            block=self.next_block["rows"]
+            if block is None:
+                raise Exception("Ran out of rows after %d, expected %d" % (self.buffer_end, self.n_rows))
+            self.read_next()
+
+            # Drop the rows before start, and add the new block
+            if self.buffer is None or start>=self.buffer_end:
+                self.buffer=block
+                self.buffer_start=self.buffer_end
+            else:
+                self.buffer=np.concatenate([self.buffer[max(0, start-self.buffer_start):], block])
+                self.buffer_start=max(start, self.buffer_start)
+            self.buffer_end+=len(block)
+
+        return self.buffer[start-self.buffer_start:end-self.buffer_start]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, end, step = index.indices(self.n_rows)
+            if step!=1:
+                raise Exception("Can only read consecutive rows")
+            return self.rows(start, end)
+        if index<0:
+            index+=self.n_rows
+        return self.rows(index, index+1)[0]
+
+##########################################################################################################
@@ -0,0 +1,149 @@
+#############################################################################
+#
+#   Copyright 2018 Iain Mathieson
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#############################################################################
+
+# Server mode: load the panel once, then answer queries for local ancestry
+# from a pool of worker processes. Queries and answers are json, one per line,
+# either on stdin/stdout or on a unix socket. A query looks like
+#     {"id": "sample1", "genotypes": [0, 1, 2, 3, ...]}
+# with one genotype per panel snp (3 is missing) and the answer looks like
+#     {"id": "sample1", "local_ancestry": [[pop1, pop2], ...], "best_parents": [[i, j], ...]}
+# or {"id": "sample1", "error": "..."} if something went wrong.
+
+from __future__ import division
+import sys, os, stat, json, signal, threading, Queue, SocketServer
+import numpy as np
+from multiprocessing import Pool
+import lace, ancestry
+
+##########################################################################################################
+
+def init_worker(data, recomb, options):
+    """
+    Pool initializer - keep the panel in the worker so queries only need to send genotypes.
+    This is the same worker state as lace uses, so the transitions for each chromosome are 
+    worked out for the first query and kept for the rest. 
+    """
+    lace.init_worker(data, recomb, options, lace.run_for_one_sample, ancestry.ancestry_n_tracebacks)
+
+##########################################################################################################
+
+def answer_query(line):
+    """
+    Run one query, given as a line of json. Returns the answer as a line of json.
+    """
+    query_id=None
+    try:
+        query=json.loads(line)
+        query_id=query.get("id")
+        data=lace.worker_state["data"]
+
+        genotypes=np.array(query["genotypes"], dtype=np.uint8).reshape(-1,1)
+        if len(genotypes)!=len(data["snp_pos"]):
+            raise Exception("Expected %d genotypes, got %d" % (len(data["snp_pos"]), len(genotypes)))
+        if np.any(genotypes>3):
+            raise Exception("Genotypes should be 0, 1, 2 or 3 (missing)")
+
+        # The query is just a panel with one query sample
+        query_data=dict(data)
+        query_data["query_names"]=[str(query_id)]
+        query_data["query_genotype_data"]=genotypes
+
+        out=lace.run_for_one_sample_by_chromosome(str(query_id), query_data, lace.worker_state["recomb"],
+                                                  lace.worker_state["options"], lace.worker_state["summary_function"])
+        answer={"id":query_id, "local_ancestry":out["local_ancestry"],
+                "best_parents":[[int(p1), int(p2)] for p1,p2 in out["best_parents"]]}
+    except Exception as ex:
+        answer={"id":query_id, "error":str(ex)}
+
+    return json.dumps(answer)+"\n"
+
+##########################################################################################################
+
+def answer_queries(in_file, out_file, pool):
+    """
+    Read queries from in_file and write answers to out_file, in the same order.
+    Queries are sent to the pool as soon as they are read, and a separate thread
+    writes the answers as they finish, so a client can either send everything at
+    once or wait for each answer.
+    """
+    pending=Queue.Queue()
+
+    def write_answers():
+        while True:
+            result=pending.get()
+            if result is None:
+                break
+            out_file.write(result.get())
+            out_file.flush()
+
+    writer=threading.Thread(target=write_answers)
+    writer.start()
+
+    for line in iter(in_file.readline, ""):
+        if line.strip():
+            pending.put(pool.apply_async(answer_query, (line,)))
+    pending.put(None)
+    writer.join()
+
+##########################################################################################################
+
+class query_handler(SocketServer.StreamRequestHandler):
+    """
+    Answer queries on one socket connection
+    """
+    def handle(self):
+        answer_queries(self.rfile, self.wfile, self.server.pool)
+
+class query_server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+##########################################################################################################
+
+def serve(options):
+    """
+    Load the panel, start the worker pool, and answer queries until stdin closes
+    or, for a socket, until we are killed.
+    """
+    data, recomb = lace.load_inputs(options)
+    lace.preprocess_data(data, options)
+
+    n_workers=options.get("multi_process", 1)
+    pool=Pool(n_workers, init_worker, (data, recomb, options))
+
+    if options["serve"]=="-":
+        print "Serving on stdin/stdout with %d workers" % n_workers
+        answer_queries(sys.stdin, sys.__stdout__, pool)
+    else:
+        if os.path.exists(options["serve"]):    # Left behind by a server that was killed
+            if not stat.S_ISSOCK(os.stat(options["serve"]).st_mode):
+                raise Exception("%s already exists and is not a socket" % options["serve"])
+            os.remove(options["serve"])
+        server=query_server(options["serve"], query_handler)
+        server.pool=pool
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # So that we clean up the socket
+        print "Serving on %s with %d workers" % (options["serve"], n_workers)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(options["serve"])
+
+    pool.close()
+    pool.join()
+
+##########################################################################################################
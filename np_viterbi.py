@@ -0,0 +1,333 @@
+#############################################################################
+#
+#   Copyright 2018 Iain Mathieson
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#############################################################################
+
+# Viterbi algorithm classes for 2-parent viterbi algorithm
+# This is a numpy version of c_viterbi3, which works on the whole vector of
+# states at each snp. It needs no compiling, and gives exactly the same
+# results as c_viterbi3, so it can be used to check changes to it.
+
+from __future__ import division
+from scipy import sparse
+from viterbi_2d_helpers import transition, emission, pseudohaploid_emission, informative_sites, expanded_calculator, start_states
+import numpy as np
+
+max_num_sparse_elems = 1e6
+
+# Number of snps to read the panel genotypes for at a time
+panel_chunk_size = 1000
+
+##########################################################################################################
+
+class calculator(object):
+    """
+    implement the viterbi algorithm using the supplied transition and emission probabilities
+    This finds the two closest related individuals, i.e. people with genotypes compatable with
+    being your parents.
+    """
+
+    def __init__(self, data, transition, emission, observed, options={}, columns=None):
+        """
+        data is the genotype matrix, and columns are the columns of it that make up the
+        panel - all of them if columns is None. It is read a chunk of snps at a time, so it
+        only has to be sliceable by rows, like for c_viterbi3. 
+        """
+        self.data=data
+        if columns is None:
+            columns=np.arange(len(data[0]))
+        self.columns=np.asarray(columns, dtype=np.int32)
+        self.transition=transition
+
+        self.observed=np.array(observed, dtype=int)
+        self.emission=emission
+        self.Nx = len(data)
+        self.Ny = len(self.columns)
+        self.options=options
+        self.stored_ordered_states=None
+        self.frequency=options["used_genotype_frequency"]
+
+        Ns = (self.Ny*(self.Ny-1))//2      # Number of states ( samples^2 but state[0] >= state[1] )
+
+        self.Ns = Ns
+        self.initial_p= [1/Ns]*Ns
+
+        # Build a map of (2D) states to indices and reversed.
+        # this: [ (1,0),(2,0),(2,1),..., (N-1,N-2) ]
+        self.states = []
+        for i in range(self.Ny):
+            for j in range(i):
+                self.states.append((i,j))
+
+    def panel_rows(self, start, end):
+        """
+        The panel genotypes for snps start to end
+        """
+        return np.asarray(self.data[start:end])[:,self.columns]
+
+    def convert_emission_to_matrix(self, f):
+        """
+        Convert the dictionary based lookup from the emission object to an array based lookup
+        That is, a 3D array indexed by {0,1,2} - genotypes, containing probabilities.
+        """
+        em=np.zeros((4,4,4), dtype=np.float64)
+        for key in self.emission.probabilities:
+            prob=self.emission.emission_probability(key[0:2], key[2], f)
+            if callable(prob):
+                em[key]=prob(f)
+            else:
+                em[key]=prob
+        return em
+
+    def best_informative(self, js, last_row, lastV, tp0, tp1, tp2):
+        """
+        For phasing everything: for each state in js, the best state to come from that
+        is informative (heterozygous) at the last snp (panel genotypes last_row), or -1 if
+        there are none with non-zero value. The value of coming from k is lastV[k] times tp0 if k is the same state,
+        tp1 if it shares one parent and tp2 if it shares none. Ties go to the lowest k.
+        """
+        s0, s1 = self.s0, self.s1
+        Ny=self.Ny
+        informative=last_row[s0]!=last_row[s1]
+        inf_idx=np.flatnonzero(informative)
+
+        best=np.zeros(len(js))
+        best_idx=np.zeros(len(js), dtype=int)-1
+
+        def offer(values, ks):
+            """
+            Take candidate ks where they beat the current best
+            """
+            better=(ks>=0) & ((values>best) | ((values==best) & (best_idx>=0) & (ks<best_idx)))
+            best[better]=values[better]
+            best_idx[better]=ks[better]
+
+        # The same state
+        offer(np.where(informative[js], lastV[js]*tp0, 0), np.where(informative[js], js, -1))
+
+        # States sharing one parent: the best two for each parent, so that we can leave out js
+        if len(inf_idx):
+            parents=np.concatenate([s0[inf_idx], s1[inf_idx]])
+            ks=np.concatenate([inf_idx, inf_idx])
+            values=lastV[ks]*tp1
+            order=np.lexsort((ks, -values, parents))
+            parents, ks, values = parents[order], ks[order], values[order]
+            first=np.flatnonzero(np.r_[True, parents[1:]!=parents[:-1]])
+            has_second=np.r_[parents[first[:-1]+1]==parents[first[:-1]], first[-1]+1<len(parents)]
+            top_idxes=np.zeros(Ny, dtype=int)-1
+            top_values=np.zeros(Ny)-1
+            second_idxes=np.zeros(Ny, dtype=int)-1
+            second_values=np.zeros(Ny)-1
+            top_idxes[parents[first]]=ks[first]
+            top_values[parents[first]]=values[first]
+            second_idxes[parents[first[has_second]]]=ks[first[has_second]+1]
+            second_values[parents[first[has_second]]]=values[first[has_second]+1]
+
+            for p in (s0[js], s1[js]):
+                use_top=top_idxes[p]!=js
+                offer(np.where(use_top, top_values[p], second_values[p]), np.where(use_top, top_idxes[p], second_idxes[p]))
+
+            # States sharing no parent: the first in order of value. At most 2*Ny-3 informative states
+            # share a parent with any state, so one of the first 2*Ny is disjoint if any are.
+            values=lastV[inf_idx]*tp2
+            order=inf_idx[np.argsort(-values, kind="mergesort")][:2*Ny]
+            disjoint=((s0[order][:,None]!=s0[js][None,:]) & (s0[order][:,None]!=s1[js][None,:]) &
+                      (s1[order][:,None]!=s0[js][None,:]) & (s1[order][:,None]!=s1[js][None,:]))
+            found=disjoint.any(axis=0)
+            ks=np.where(found, order[disjoint.argmax(axis=0)], -1)
+            offer(np.where(found, lastV[ks]*tp2, 0), ks)
+
+        return best_idx
+
+    def calculate(self):
+        """
+        Calculate the viterbi matrix and the traceback matrix, exactly as c_viterbi3 does,
+        but a whole snp at a time.
+        """
+        everything = self.options.get("everything", False) # Do we have to try and phase everything?
+
+        Nx = self.Nx     # Number of markers
+        Ny = self.Ny     # Number of samples
+        Ns = self.Ns     # Number of states ( samples^2 but state[0] > state[1] )
+        max_nse = int(self.options.get("sparse_buffer_size", max_num_sparse_elems))
+        max_tb_k = self.options["traceback_lookback_k"]
+        observed = self.observed
+
+        states=np.array(self.states, dtype=int).reshape(-1,2)
+        self.s0, self.s1 = s0, s1 = states[:,0], states[:,1]
+        all_states=np.arange(Ns)
+
+        # Indices to look up for each pair of parents. Note that [j,j] is state 0, as in c_viterbi3
+        state_indices=np.zeros((Ny,Ny), dtype=int)
+        state_indices[s0,s1]=all_states
+        state_indices[s1,s0]=all_states
+
+        tb_arr=np.zeros((max_tb_k,Ns), dtype=int)
+        t = sparse.lil_matrix((Nx,Ns), dtype=int).tocoo()
+        I, J, V = [], [], []
+        nse=0
+        total_nse=0
+        n_flushes=0
+
+        # Setup first row.
+        tb_k=0
+        panel=self.panel_rows(0, 1)
+        panel_start=0
+        row=panel[0]
+        lastV=np.array([p*self.emission.emission_probability((row[a], row[b]), observed[0], self.frequency[0])
+                        for p, (a, b) in zip(self.initial_p, self.states)], dtype=np.float64)
+        tb_arr[0,:]=all_states
+        best_last_V=lastV.max()
+        if best_last_V > 0:
+            lastV=lastV/best_last_V
+        else:
+            lastV[:]=1/Ns
+
+        # For each snp
+        for i in range(1, Nx):
+            tp0, tp1, tp2 = self.transition.single_transition_probability(i)
+            best_last_V_tp1=best_last_V*tp1
+            em=self.convert_emission_to_matrix(self.frequency[i])
+
+            # Best state including each parent - the first, if there is a tie
+            around=lastV[state_indices]
+            best_ks=around.argmax(axis=1)
+            best_idxes=state_indices[np.arange(Ny), best_ks]
+            best_values=lastV[best_idxes]*tp1
+
+            # For each state see what the most likely previous state was.
+            best=lastV*tp0
+            best_idx=all_states.copy()
+            move_first=~(best_values[s0]<best_values[s1])
+            best_move=np.where(move_first, best_values[s0], best_values[s1])
+            best_move_idx=np.where(move_first, best_idxes[s0], best_idxes[s1])
+            move=(best<best_last_V_tp1) & (best<best_move)
+            best=np.where(move, best_move, best)
+            best_idx=np.where(move, best_move_idx, best_idx)
+
+            if i-panel_start>=len(panel):
+                panel_start=i-1
+                panel=self.panel_rows(panel_start, min(Nx, i+panel_chunk_size))
+            row=panel[i-panel_start]
+            last_row=panel[i-1-panel_start]
+            thisV=best*em[row[s0], row[s1], observed[i]]
+            tb_arr[tb_k,:]=best_idx
+
+            # If we have demanded that we phase *everything* and site we're going to is not phasable
+            # then try and find the best informative state.
+            if everything and observed[i-1]==1:
+                informative=last_row[s0]!=last_row[s1]
+                js=np.flatnonzero(~informative[best_idx])
+                if len(js):
+                    found=self.best_informative(js, last_row, lastV, tp0, tp1, tp2)
+                    tb_arr[tb_k,js[found>-1]]=-found[found>-1]-2
+
+            # Traceback if we're on a multiple of chunk size, or at the end. Follow each state
+            # back, in order of state, marking where we have been. A later state reaching
+            # somewhere marked reads -1, so we do all the states a step at a time, and the
+            # first (lowest) state to reach each place reads it.
+            if (tb_k+1==max_tb_k) or (i+1==Nx):
+                idx=all_states.copy()
+                for k in range(tb_k):
+                    row=tb_arr[tb_k-k]
+                    first=np.zeros(Ns, dtype=bool)
+                    first[np.unique(idx, return_index=True)[1]]=True
+                    next_idx=np.where(first, row[idx], -1)
+                    row[idx]=-1
+
+                    changed=next_idx!=idx
+                    stored=changed & (next_idx!=-1) # Entries of 0 (next_idx==-1) don't change the matrix
+                    I.append(np.zeros(stored.sum(), dtype=int)+i-k)
+                    J.append(idx[stored])
+                    V.append(next_idx[stored]+1) # Sparse matrix returns 0 for empty, so shift everything by 1
+                    nse+=changed.sum()
+                    idx=np.where(next_idx>=0, next_idx, idx)
+
+                if nse>=max_nse:
+                    t=t+sparse.coo_matrix((np.concatenate(V),(np.concatenate(I),np.concatenate(J))),shape=(Nx,Ns),dtype=int)
+                    I, J, V = [], [], []
+                    total_nse+=nse
+                    n_flushes+=1
+                    nse=0
+
+            # Move traceback on, wrapping round if required
+            tb_k = (tb_k + 1) % max_tb_k
+
+            best_last_V=thisV.max()
+            if best_last_V==0:
+                raise ZeroDivisionError("float division")
+            lastV = thisV/best_last_V
+            thisV = lastV
+            best_last_V=1.0 # We are normalising everything so that the best element==1
+
+        # Finally save everything
+        self.viterbi = lastV
+        if I:
+            t=t+sparse.coo_matrix((np.concatenate(V),(np.concatenate(I),np.concatenate(J))),shape=(Nx,Ns),dtype=int)
+        self.traceback_matrix = t.tocsr()
+        self.stored_ordered_states=None
+        self.counters = {"snps":Nx, "states":Ns, "traceback_entries":total_nse+nse, "sparse_flushes":n_flushes+1}
+
+    def ordered_viterbi_states(self):
+        """
+        Get the states in order of the best Viterbi score
+        """
+        if self.stored_ordered_states is None:
+            V = self.viterbi
+            to_sort = zip([-v for v in V], range(len(V)))
+            to_sort.sort()
+            self.stored_ordered_states=[s[1] for s in to_sort]
+
+        return self.stored_ordered_states
+
+    def traceback(self, n_paths=1, use_everything=True):
+        """
+        Get the traceback of one of the most likely paths
+        which path=i gets the i+1th best path.
+        """
+        max_tb_k = self.options["traceback_lookback_k"]
+        Nx = self.Nx
+        t=self.traceback_matrix[(Nx-max_tb_k):Nx,:].toarray()
+
+        ordered_elems=self.ordered_viterbi_states()
+        index=list(start_states(ordered_elems, self.states, n_paths, self.options))
+        one_step_index=[-1]*n_paths   # -1 for none
+        paths=[[None]*Nx for k in range(n_paths)]
+
+        for i in range(Nx):
+            t_i=i % max_tb_k
+            s_i=max_tb_k-t_i-1
+
+            if t_i==0 and i>0:
+                start=max(0,Nx-i-max_tb_k)-(Nx-i-max_tb_k)
+                t[start:max_tb_k,]=self.traceback_matrix[max(0,Nx-i-max_tb_k):(Nx-i),:].toarray()
+            for j in range(n_paths):
+                if one_step_index[j]>=0:
+                    paths[j][i]=self.states[one_step_index[j]]
+                    one_step_index[j]=-1
+                else:
+                    paths[j][i]=self.states[index[j]]
+
+                    back_trace=t[s_i,index[j]]-1
+                    if back_trace>=0:
+                        index[j]=back_trace
+                    if back_trace<=-2 and use_everything:   # jump off the optimal path for one step to avoid unphasable site.
+                        one_step_index[j]=-back_trace-2
+
+        [path.reverse() for path in paths]
+        return paths
+
+##########################################################################################################
@@ -21,50 +21,107 @@
 # to run on, 
 
 from __future__ import division
+import hashlib
 import numpy as np
 from numpy import array
+from viterbi_2d_helpers import panel_blocks
 
 ##########################################################################################################
 
-def closest_n( data, sample_names, observations, n, method="incompatable" ):
+def closest_n( data, columns, sample_names, observations, n, method="incompatable", weights=None ):
     """
-    Select the n individuals from the dataset which are closest to observation, 
-    using a given method to rank them. Returns the reduced dataset and the 
-    selected sample names
+    Select the n individuals from the panel (the columns of data, called sample_names) 
+    which are closest to observation, using a given method to rank them. Returns the 
+    selected columns and sample names. Weights can be precomputed (e.g. from a panel index)
     """
 
-    dists = distance_methods[method](data, observations)
+    dists = distance_methods[method](data, columns, observations, weights)
 
     dists = zip(dists, sample_names)
     dists.sort()
     top_n_samples=[x[1] for x in dists[:n]]
 
-    new_samples = [s for s in sample_names if s in top_n_samples]
     include = array([(s in top_n_samples) for s in sample_names])
-    new_data = data[:,include]
+    new_samples = [s for s, inc in zip(sample_names, include) if inc]
 
-    return new_data, new_samples
+    return np.asarray(columns)[include], new_samples
 
 ##########################################################################################################
-def incompatable_distance(data, observations):
+def incompatable_distance(data, columns, observations, weights=None):
     """
     count the number of incompatable sites (0 vs 2), weight by
     allele frequency, rank
     """
     
-    frequency = data.mean(axis=1)
-    frequency = np.choose(frequency>0, (-1,frequency))
-    weights = np.choose(frequency>0, (0, 1/frequency))
+    if weights is None:
+        weights = frequency_weights(data, columns)
 
-    def  obs_mult(x): return (abs(x-observations)==2) * weights
-    
-    incomp_array = np.apply_along_axis(obs_mult, 0, data)
-    scores = incomp_array.sum(axis=0)
+    observations = np.asarray(observations, dtype=int)
+    scores = np.zeros(len(columns))
+    for start, end, block in panel_blocks(data, columns):
+        # Genotypes are unsigned, so make them signed before subtracting
+        incomp = abs(block.astype(int)-observations[start:end,None])==2
+        scores += (incomp * weights[start:end,None]).sum(axis=0)
 
     return scores
 
 ##########################################################################################################
 
+def frequency_weights(data, columns=None):
+    """
+    Weight for each snp in incompatable_distance: one over the mean genotype
+    of the panel (columns of data), or 0 if the mean is 0
+    """
+    frequency = np.concatenate([block.mean(axis=1) for start, end, block in panel_blocks(data, columns)])
+    frequency = np.choose(frequency>0, (-1,frequency))
+    return np.choose(frequency>0, (0, 1/frequency))
+
+##########################################################################################################
+
 distance_methods = { "incompatable": incompatable_distance }
 
 ##########################################################################################################
+
+def collapse_duplicates( data, sample_indices, populations ):
+    """
+    Find columns of data which are identical, and come from the same population, and keep 
+    at most two of each - two so that the state with both parents from the group still 
+    exists. The viterbi algorithm takes the maximum, not the sum, over paths, and a path
+    through a dropped copy has exactly the same probability as the one through a kept copy, 
+    so this gives the same best paths as the full panel, as long as the transition 
+    probabilities are still calculated for the full panel size (N_samples). But the top
+    n_traceback_paths states, which vote on local ancestry, would change, so we return how
+    many samples each kept one stands for (the first of a group stands for all but one 
+    of them) and which group it is from, so that the tracebacks can count each kept state
+    once for each pair of samples it stands for (see viterbi_2d_helpers.start_states). 
+    The panel is the columns sample_indices of data, which we hash a block of snps at a 
+    time rather than copying whole columns. Returns the positions in sample_indices to keep, 
+    the multiplicity and the group of each. 
+    """
+    hashes = [hashlib.sha1() for index in sample_indices]
+    for start, end, block in panel_blocks(data, sample_indices):
+        block = np.ascontiguousarray(block.T)
+        for col in range(len(sample_indices)):
+            hashes[col].update(block[col])
+
+    groups = {}
+    keep = []
+    for col, index in enumerate(sample_indices):
+        key = (hashes[col].digest(), populations[index])
+        group = groups.setdefault(key, [])
+        if len(group) < 2:
+            keep.append(col)
+        group.append(col)
+
+    multiplicity = {}
+    group_number = {}
+    for number, group in enumerate(groups.values()):
+        multiplicity[group[0]] = len(group)-1 if len(group)>1 else 1
+        if len(group)>1:
+            multiplicity[group[1]] = 1
+        for col in group[:2]:
+            group_number[col] = number
+
+    return array(keep), array([multiplicity[col] for col in keep]), array([group_number[col] for col in keep])
+
+##########################################################################################################
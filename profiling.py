@@ -0,0 +1,162 @@
+#############################################################################
+#
+#   Copyright 2018 Iain Mathieson
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#############################################################################
+
+# Timing and memory instrumentation. Records wall time, cpu time and peak
+# memory for each stage of a run, along with counters, and writes a report.
+
+from __future__ import division
+import time, resource, json, cProfile
+from contextlib import contextmanager
+
+##########################################################################################################
+
+def cpu_time():
+    """
+    User plus system cpu time for this process, in seconds
+    """
+    usage=resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime+usage.ru_stime
+
+##########################################################################################################
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in Mb (ru_maxrss is in kb on linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+##########################################################################################################
+
+class profiler(object):
+    """
+    Record wall time, cpu time and peak rss for a sequence of named stages, and
+    a dictionary of counters. Cheap enough to leave on all the time.
+    """
+
+    def __init__(self):
+        self.stages=[]
+        self.counters={}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time everything inside the with block as stage name
+        """
+        wall=time.time()
+        cpu=cpu_time()
+        try:
+            yield
+        finally:
+            self.stages.append({"stage":name, "wall":time.time()-wall, "cpu":cpu_time()-cpu,
+                                "peak_rss_mb":peak_rss_mb()})
+
+    def count(self, name, n=1):
+        """
+        Add n to the counter name
+        """
+        self.counters[name]=self.counters.get(name, 0)+n
+
+    def summary(self):
+        """
+        Everything recorded so far, as a dictionary
+        """
+        return {"stages":self.stages, "counters":self.counters}
+
+##########################################################################################################
+
+class progress_meter(object):
+    """
+    Report progress through a set of tasks as they finish, with the throughput 
+    and an estimate of the time left. Tasks can have different costs, so the 
+    estimate is based on the fraction of the total cost that is done. 
+    """
+
+    def __init__(self, n_tasks, total_cost):
+        self.n_tasks=n_tasks
+        self.total_cost=total_cost
+        self.n_done=0
+        self.cost_done=0
+        self.start=time.time()
+
+    def update(self, name, cost):
+        """
+        Record that the task name, with this cost, has finished, and print a progress line
+        """
+        self.n_done+=1
+        self.cost_done+=cost
+        elapsed=time.time()-self.start
+
+        if self.total_cost and self.cost_done:
+            left=elapsed*(self.total_cost-self.cost_done)/self.cost_done
+        else:
+            left=elapsed*(self.n_tasks-self.n_done)/self.n_done
+
+        print "\033[1A%s [%d/%d] %1.2f samples/s, ETA %s     " % (name, self.n_done, self.n_tasks, 
+                        self.n_done/max(elapsed, 1e-6), format_seconds(left))
+
+##########################################################################################################
+
+def format_seconds(seconds):
+    """
+    Format a number of seconds as h:mm:ss
+    """
+    seconds=int(round(seconds))
+    return "%d:%02d:%02d" % (seconds//3600, seconds%3600//60, seconds%60)
+
+##########################################################################################################
+
+@contextmanager
+def cprofile_to(file_name):
+    """
+    Run the with block under cProfile and dump the stats to file_name. If
+    file_name is None, do nothing.
+    """
+    if not file_name:
+        yield
+        return
+
+    prof=cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(file_name)
+
+##########################################################################################################
+
+def write_report(file_name, run_profile, sample_profiles, options):
+    """
+    Write the run and per-sample profiles as json. Totals over samples are included
+    so that you can see where the time went without post-processing.
+    """
+    totals={}
+    for sample_profile in sample_profiles.values():
+        for stage in sample_profile["stages"]:
+            total=totals.setdefault(stage["stage"], {"wall":0.0, "cpu":0.0})
+            total["wall"]+=stage["wall"]
+            total["cpu"]+=stage["cpu"]
+
+    report={"options":dict((k,str(v)) for k,v in options.items() if not isinstance(v, list)),
+            "run":run_profile, "sample_totals":totals, "samples":sample_profiles}
+
+    out_file=open(file_name, "w")
+    json.dump(report, out_file, indent=1, sort_keys=True)
+    out_file.close()
+
+##########################################################################################################
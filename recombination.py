@@ -18,7 +18,6 @@
 
 # Dealing with recombination rates and the genetic map
 
-from scipy import interpolate
 import gzip
 
 ##########################################################################################################
@@ -33,11 +32,25 @@ def get_recombinator(recombination_data):
         print "Using constant recombination rate " + str(rec_rate) + " cm/Mb"
         return constant_recombinator(rec_rate)
     except ValueError:
+        if "{chrom}" in recombination_data:
+            print "Using recombination maps " + recombination_data
+            return chromosome_recombinator(recombination_data)
         print "Loading recombination map from " + recombination_data
         return recombinator(recombination_data)
 
 ##########################################################################################################
 
+def for_chromosome(recombinator, chrom):
+    """
+    Get the recombinator to use for one chromosome. Most recombinators are the 
+    same for every chromosome. chrom is None if we don't know about chromosomes.
+    """
+    if chrom is not None and hasattr(recombinator, "for_chromosome"):
+        return recombinator.for_chromosome(chrom)
+    return recombinator
+
+##########################################################################################################
+
 class recombinator(object):
     """
     Class to interpolate the genetic distance between two positions, given am IMPUTE stype recombination map.
@@ -70,6 +83,7 @@ class recombinator(object):
         self.max_pos = max(self.position)
         self.min_pos = min(self.position)
 
+        from scipy import interpolate   # Only needed here, and slow to import
         self.fitter = interpolate.UnivariateSpline(self.position, self.dist, k=1, s=0) # Linear interpolation
 
     def parse_header(self, header_line):
@@ -115,3 +129,73 @@ class constant_recombinator(object):
 
 ##########################################################################################################
 
+class chromosome_recombinator(object):
+    """
+    A different recombination map for each chromosome. The file name template should 
+    contain {chrom}, which is replaced by the chromosome name. Maps are loaded when needed.
+    """
+    
+    def __init__(self, template):
+        self.template=template
+        self.recombinators={}
+
+    def for_chromosome(self, chrom):
+        if chrom not in self.recombinators:
+            self.recombinators[chrom]=recombinator(self.template.replace("{chrom}", str(chrom)))
+        return self.recombinators[chrom]
+
+    def distance(self, position_1, position_2):
+        raise Exception("Need to know the chromosome to use per-chromosome recombination maps")
+
+##########################################################################################################
+
+class indexed_recombinator(object):
+    """
+    Class to give the genetic distance between snps using precomputed distances (in cM) 
+    from each snp to the one before, for a fixed set of snps - e.g. from a panel index. 
+    Only knows about those positions. We keep the intervals rather than cumulative map 
+    positions so that neighbouring snps get exactly the distance the original recombinator 
+    gave - subtracting map positions is slightly off, which can break ties differently.
+    """
+    
+    def __init__(self, positions, map_intervals, chroms=None):
+        self.positions=positions
+        self.map_intervals=map_intervals
+        self.chroms=chroms
+        self.index=dict((p, j) for j, p in enumerate(positions))
+
+    def for_chromosome(self, chrom):
+        if self.chroms is None:
+            return self
+        keep=[j for j,c in enumerate(self.chroms) if c==chrom]
+        return indexed_recombinator([self.positions[j] for j in keep], [self.map_intervals[j] for j in keep])
+
+    def distance(self, position_1, position_2):
+        """
+        Return the genetic distance in cm between two snps - the sum of the intervals
+        between them if they are not neighbours (e.g. with --skip)
+        """
+        index_1, index_2 = self.index[position_1], self.index[position_2]
+        if index_2<index_1:
+            return -self.distance(position_2, position_1)
+        if index_2==index_1+1:
+            return self.map_intervals[index_2]
+        return sum(self.map_intervals[index_1+1:index_2+1])
+
+##########################################################################################################
+
+def map_intervals(recombinator, positions, chroms=None):
+    """
+    Genetic distance in cM from each snp to the one before it, or 0 for the first 
+    snp on each chromosome, using any recombinator. 
+    """
+    intervals=[]
+    for t in range(len(positions)):
+        chrom=None if chroms is None else chroms[t]
+        if t==0 or (chroms is not None and chroms[t-1]!=chrom):
+            intervals.append(0.0)
+        else:
+            intervals.append(for_chromosome(recombinator, chrom).distance(positions[t-1], positions[t]))
+    return intervals
+
+##########################################################################################################
@@ -0,0 +1,65 @@
+#############################################################################
+#
+#   Copyright 2018 Iain Mathieson
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#############################################################################
+
+# Measure how long lace takes to start: printing the help, importing it, and
+# short runs on the test data, where starting up (and, with -u, starting the
+# worker processes) is a large part of the time. Prints the median wall time
+# of several repeats of each.
+# Usage: python startup_benchmark.py [repeats]
+
+from __future__ import division
+import sys, os, time, subprocess, tempfile, shutil
+
+##########################################################################################################
+
+def median_time(command, repeats):
+    """
+    Median wall time, in seconds, of running command (a list of arguments to python) repeats times
+    """
+    times=[]
+    for r in range(repeats):
+        start=time.time()
+        subprocess.check_call([sys.executable]+command, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        times.append(time.time()-start)
+    times.sort()
+    return times[len(times)//2]
+
+##########################################################################################################
+
+def main(repeats):
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    out_dir=tempfile.mkdtemp()
+    run=["lace.py", "-m", "testdata.gt.txt", "-p", "testpops.txt", "-o", os.path.join(out_dir, "out"),
+         "-i", "test1,test2,test3,test4"]
+
+    benchmarks=[("lace.py -h", ["lace.py", "-h"]),
+                ("import lace", ["-c", "import lace"]),
+                ("4 samples", run),
+                ("4 samples, 2 processes", run+["-u", "2"]),
+                ("4 samples, 4 processes", run+["-u", "4"])]
+
+    try:
+        for name, command in benchmarks:
+            print "%-25s %1.3fs" % (name, median_time(command, repeats))
+    finally:
+        shutil.rmtree(out_dir)
+
+##########################################################################################################
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv)>1 else 5)
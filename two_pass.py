@@ -0,0 +1,161 @@
+#############################################################################
+#
+#   Copyright 2018 Iain Mathieson
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+#
+#############################################################################
+
+# Coarse to fine version of the 2-parent viterbi algorithm. First run the
+# full calculator on every n-th snp, then rerun at full resolution only in
+# windows around the places where the coarse paths switch parents, using only
+# the panel samples that the coarse paths use there.
+
+from __future__ import division
+import numpy as np
+from viterbi_2d_helpers import expand_sites
+
+##########################################################################################################
+
+class calculator(object):
+    """
+    Same interface as the full calculator, but does the work in two passes.
+    engine is the full calculator class, and make_transition(positions) makes
+    a transition object for a subset of the snps. As for the full calculator, 
+    the panel is the columns of data (all of them if columns is None).
+    """
+
+    def __init__(self, engine, make_transition, emission, data, observed, positions, options, columns=None):
+        self.engine=engine
+        self.make_transition=make_transition
+        self.emission=emission
+        self.data=data
+        if columns is None:
+            columns=np.arange(len(data[0]))
+        self.columns=np.asarray(columns, dtype=np.int32)
+        self.observed=np.asarray(observed)
+        self.positions=np.asarray(positions)
+        self.options=options
+        self.Nx=len(data)
+        self.Ny=len(self.columns)
+        self.counters={}
+
+    def run(self, rows, columns, n_paths, use_everything, start_pair=None, end_pair=None):
+        """
+        Run the full calculator on a subset of the snps (rows, a sorted index array) and
+        panel samples (columns), and return tracebacks as lists of pairs of panel indices.
+        A run of consecutive snps is passed as a view of the data, anything else is copied. 
+        If start_pair (end_pair) is given, the paths come from (go to) that pair of panel 
+        samples at the snp before the first row (after the last row), rather than anywhere. 
+        """
+        options=self.options.copy()
+        options["used_genotype_frequency"]=np.asarray(self.options["used_genotype_frequency"])[rows]
+        options["traceback_lookback_k"]=min(self.options["traceback_lookback_k"], len(rows))
+        if self.options.get("panel_multiplicity") is not None:
+            options["panel_multiplicity"]=np.asarray(self.options["panel_multiplicity"])[columns]
+            options["panel_groups"]=np.asarray(self.options["panel_groups"])[columns]
+
+        if rows[-1]-rows[0]+1==len(rows):
+            data, data_columns = self.data[rows[0]:rows[-1]+1], self.columns[columns]
+        else:
+            data, data_columns = self.data[np.ix_(rows, self.columns[columns])], None
+
+        vit=self.engine(data, self.make_transition(self.positions[rows]),
+                        self.emission, self.observed[rows], options, data_columns)
+        if start_pair is not None:
+            vit.initial_p=self.pair_transitions(rows[0], columns, start_pair, vit.states)
+        vit.calculate()
+        if end_pair is not None:    # Tracebacks start from the states with the highest final viterbi values
+            vit.viterbi=np.asarray(vit.viterbi)*self.pair_transitions(rows[-1]+1, columns, end_pair, vit.states)
+        for counter, n in vit.counters.items():
+            self.counters[counter]=self.counters.get(counter, 0)+n
+
+        tbs=vit.traceback(n_paths=min(n_paths, vit.Ns), use_everything=use_everything)
+        return [[(columns[s0], columns[s1]) for s0, s1 in tb] for tb in tbs]
+
+    def pair_transitions(self, row, columns, pair, states):
+        """
+        Transition probabilities between pair (of panel samples) at one of the snps row-1 
+        and row, and each of states (pairs of positions in columns) at the other - for 
+        staying, changing one parent, or changing both. 
+        """
+        tp=self.make_transition(self.positions[row-1:row+1]).single_transition_probability(1)
+        pair=set(pair)
+        return np.array([tp[2-len(pair & set((columns[s0], columns[s1])))] for s0, s1 in states])
+
+    def switch_windows(self, coarse_rows, coarse_tbs, margin):
+        """
+        Windows of snps, [start, end), that cover every switch in the coarse paths,
+        plus margin snps on either side, merged where they overlap.
+        """
+        windows=[]
+        for c in range(1, len(coarse_rows)):
+            if any(tb[c]!=tb[c-1] for tb in coarse_tbs):
+                start=max(0, coarse_rows[c-1]-margin)
+                end=min(self.Nx, coarse_rows[c]+margin+1)
+                if windows and start<=windows[-1][1]:
+                    windows[-1]=(windows[-1][0], max(end, windows[-1][1]))
+                else:
+                    windows.append((start, end))
+        return windows
+
+    def calculate(self):
+        """
+        Do both passes and store the paths.
+        """
+        thin=self.options["two_pass"]
+        n_paths=self.options["n_traceback_paths"]
+        use_everything=self.options.get("everything", False)
+
+        coarse_sites=np.zeros(self.Nx, dtype=bool)
+        coarse_sites[::thin]=True
+        coarse_sites[-1]=True
+        coarse_rows=np.flatnonzero(coarse_sites)
+        coarse_tbs=self.run(coarse_rows, np.arange(self.Ny), n_paths, use_everything)
+
+        # Between switches, use the coarse paths
+        paths=[expand_sites(tb, coarse_sites, self.positions) for tb in coarse_tbs]
+
+        # The coarse switches can be some way from the real ones, so look well either side. 
+        # Each window starts and ends where the best coarse path is either side of it, so 
+        # that the fine paths join up with it. 
+        windows=self.switch_windows(coarse_rows, coarse_tbs, 5*thin)
+        n_fine_snps=0
+        for start, end in windows:
+            in_window=(coarse_rows>=start) & (coarse_rows<end)
+            start_pair=paths[0][start-1] if start>0 else None
+            end_pair=paths[0][end] if end<self.Nx else None
+            columns=set(p for tb in coarse_tbs for c in np.flatnonzero(in_window) for p in tb[c])
+            for pair in (start_pair, end_pair):
+                if pair is not None:
+                    columns.update(pair)
+            columns=np.array(sorted(columns))
+            fine_tbs=self.run(np.arange(start, end), columns, n_paths, use_everything, start_pair, end_pair)
+            for path, tb in zip(paths, fine_tbs+[fine_tbs[-1]]*(n_paths-len(fine_tbs))):
+                path[start:end]=tb
+            n_fine_snps+=end-start
+
+        self.paths=paths
+        self.Ns=self.Ny*(self.Ny-1)//2
+        self.counters.update({"snps":self.Nx, "states":self.Ns, "coarse_snps":len(coarse_rows),
+                              "fine_snps":n_fine_snps, "fine_windows":len(windows)})
+
+    def traceback(self, n_paths=1, use_everything=True):
+        """
+        The paths from calculate, which used options["n_traceback_paths"] and options["everything"]
+        """
+        if n_paths>len(self.paths):
+            raise Exception("Only calculated %d paths, asked for %d" % (len(self.paths), n_paths))
+        return [list(path) for path in self.paths[:n_paths]]
+
+##########################################################################################################
@@ -19,6 +19,10 @@
 # Helper classes for 2-parent viterbi algorithm
 from __future__ import division
 from math import exp, log, fsum
+import numpy as np
+
+# Number of snps to copy at a time when we need part of the panel
+panel_block_snps = 10000
 
 ##########################################################################################################
 
@@ -199,6 +203,11 @@ class pseudohaploid_emission(emission):
                                (3,3,2): lambda z: z,
                                (3,3,3): lambda z: self.m,
                                    }
+
+        # A missing observation is equally likely whatever the hidden state
+        for h0 in (0,2,3):
+            for h1 in (0,2,3):
+                self.probabilities[(h0,h1,3)]=lambda z: self.m
         
     def emission_probability(self, hid, obs, f):
         """ 
@@ -223,3 +232,101 @@ class pseudohaploid_emission(emission):
         return p
     
 ##########################################################################################################
+
+def panel_blocks(data, columns=None, block_size=panel_block_snps):
+    """
+    Go through the panel columns of data (all of them if columns is None) a block 
+    of snps at a time, yielding (start, end, block), so that we never copy the whole 
+    panel at once. 
+    """
+    for start in range(0, len(data), block_size):
+        end=min(len(data), start+block_size)
+        if columns is None:
+            yield start, end, data[start:end]
+        else:
+            yield start, end, data[start:end][:,columns]
+
+##########################################################################################################
+
+def informative_sites(data, observed, columns=None):
+    """
+    Which snps carry any information - i.e. the emission probability is not the
+    same for every state. It is the same where the observation is missing, or where
+    every panel sample (columns of data) has the same genotype. The first snp is 
+    always kept so that there is something to start from.
+    """
+    informative=(np.asarray(observed)!=3)
+    for start, end, block in panel_blocks(data, columns):
+        informative[start:end]&=np.any(block!=block[:,0:1], axis=1)
+    informative[0]=True
+    return informative
+
+##########################################################################################################
+
+def start_states(ordered_states, states, n_paths, options):
+    """
+    The states to start n_paths tracebacks from: the first n_paths of ordered_states. If 
+    the panel was collapsed (see preclustering.collapse_duplicates), each state stands for
+    several pairs of samples in the full panel, and is used once for each of them, so that 
+    the tracebacks vote on local ancestry as they would with the full panel. 
+    options["panel_multiplicity"] is how many samples each panel sample stands for, and 
+    options["panel_groups"] which group of identical samples it is from. 
+    """
+    multiplicity=options.get("panel_multiplicity")
+    if multiplicity is None:
+        return [ordered_states[s] for s in range(n_paths)]
+
+    groups=options["panel_groups"]
+    starts=[]
+    for s in ordered_states:
+        i, j = states[s]
+        if groups[i]==groups[j]:    # Both parents from the same group - any two of its samples
+            n=(multiplicity[i]+multiplicity[j])*(multiplicity[i]+multiplicity[j]-1)//2
+        else:
+            n=multiplicity[i]*multiplicity[j]
+        starts.extend([s]*min(n, n_paths-len(starts)))
+        if len(starts)==n_paths:
+            return starts
+    raise Exception("Only %d pairs of panel samples, asked for %d paths" % (len(starts), n_paths))
+
+##########################################################################################################
+
+def expand_sites(values, kept_sites, positions):
+    """
+    Expand a list of values at the kept snps back to all the snps. Skipped snps 
+    get the value from the nearest kept snp on either side, splitting each gap at 
+    its midpoint (by position).
+    """
+    kept=np.flatnonzero(kept_sites)
+    positions=np.asarray(positions)
+    kept_pos=positions[kept]
+    all_sites=np.arange(len(positions))
+
+    before=np.searchsorted(kept, all_sites, side="right")-1
+    after=np.minimum(np.searchsorted(kept, all_sites), len(kept)-1)
+    use_after=(positions-kept_pos[before]) > (kept_pos[after]-positions)
+    source=np.where(use_after, after, before)
+
+    return [values[s] for s in source]
+
+##########################################################################################################
+
+class expanded_calculator(object):
+    """
+    Wraps a calculator that was run on only the kept snps, so that tracebacks
+    cover all the snps. Everything else is passed through to the calculator.
+    """
+
+    def __init__(self, calculator, kept_sites, positions):
+        self.calculator=calculator
+        self.kept_sites=kept_sites
+        self.positions=positions
+
+    def traceback(self, *args, **kwargs):
+        tbs=self.calculator.traceback(*args, **kwargs)
+        return [expand_sites(tb, self.kept_sites, self.positions) for tb in tbs]
+
+    def __getattr__(self, name):
+        return getattr(self.calculator, name)
+
+##########################################################################################################